@@ -0,0 +1,16 @@
+cell clearing
+fills eight cells with large values and clears them one by one
+forty thousand times
+
+++++++++++[>++++++++++++++++++++<-]>
+[
+    >++++++++++[>++++++++++++++++++++<-]>
+    [
+        >+++++++++++++++++++++++++
+        [>++++++++>+++++++>++++++>+++++>++++>+++>++>+<<<<<<<<-]
+        >[-]>[-]>[-]>[-]>[-]>[-]>[-]>[-]
+        <<<<<<<<<-
+    ]
+    <<-
+]
+++++++++++.
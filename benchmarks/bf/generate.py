@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+
+"""
+generates the brainfuck programs of the benchmark suite
+the programs are checked in, rerun this after changing it
+"""
+
+import os
+
+class Emitter:
+    """builds brainfuck code that works on fixed cells, keeping track of the pointer"""
+
+    def __init__(self):
+        self.code = []
+        self.pos = 0
+
+    def goto(self, cell):
+        d = cell - self.pos
+        self.code.append('>' * d if d > 0 else '<' * -d)
+        self.pos = cell
+
+    def add(self, cell, n):
+        self.goto(cell)
+        self.code.append('+' * n if n > 0 else '-' * -n)
+
+    def clear(self, cell):
+        self.goto(cell)
+        self.code.append('[-]')
+
+    def out(self, cell):
+        self.goto(cell)
+        self.code.append('.')
+
+    def loop(self, cell, body):
+        """run body while cell is not 0, body has to change cell"""
+
+        self.goto(cell)
+        self.code.append('[')
+        body()
+        self.goto(cell)
+        self.code.append(']')
+
+    def move(self, src, *dsts):
+        """add src to all dsts, clearing src"""
+
+        def body():
+            self.add(src, -1)
+            for dst in dsts:
+                self.add(dst, 1)
+
+        self.loop(src, body)
+
+    def copy_add(self, src, dst, tmp):
+        """add src to dst, keeping src (tmp has to be 0)"""
+
+        self.move(src, dst, tmp)
+        self.move(tmp, src)
+
+    def mul(self, dst, a, b, t1, t2):
+        """dst = a * b (t1 and t2 have to be 0)"""
+
+        self.clear(dst)
+        self.copy_add(b, t1, t2)
+
+        def body():
+            self.copy_add(a, dst, t2)
+            self.add(t1, -1)
+
+        self.loop(t1, body)
+
+    def source(self, width=72):
+        code = ''.join(self.code)
+        return '\n'.join(code[i:i+width] for i in range(0, len(code), width)) + '\n'
+
+def mandelbrot(width=24, height=10, iterations=12):
+    """
+    mandelbrot-style escape time grid, in 8 bit arithmetic:
+    for every cell c of the grid, iterate z = z*z + c from z = 0, sum up z and print a character for the sum / 8
+    """
+
+    e = Emitter()
+    Y, X, I, C, Z, SQ, F, T, S, Q, R, T1, T2 = range(13)
+
+    e.add(Y, height)
+
+    def row():
+        e.add(X, width)
+
+        def pixel():
+            # c = 7x + 13y + 1
+            e.clear(C)
+            e.add(C, 1)
+            for cell, factor in ((X, 7), (Y, 13)):
+                e.copy_add(cell, T, T1)
+
+                def scale():
+                    e.add(T, -1)
+                    e.add(C, factor)
+
+                e.loop(T, scale)
+
+            e.clear(Z)
+            e.add(I, iterations)
+
+            def iterate():
+                e.mul(SQ, Z, Z, T1, T2)
+                e.clear(Z)
+                e.move(SQ, Z)
+                e.copy_add(C, Z, T1)
+                e.copy_add(Z, S, T1)
+                e.add(I, -1)
+
+            e.loop(I, iterate)
+
+            # q = s / 8, one step at a time: r counts up to 8, then q is incremented
+            e.copy_add(S, T, T1)
+
+            def divide():
+                e.add(T, -1)
+                e.add(R, 1 - 8)
+
+                # f = r == 8
+                e.add(F, 1)
+                e.copy_add(R, T2, T1)
+
+                def not_eight():
+                    e.clear(F)
+                    e.clear(T2)
+
+                e.loop(T2, not_eight)
+                e.add(R, 8)
+
+                def carry():
+                    e.clear(R)
+                    e.add(Q, 1)
+                    e.add(F, -1)
+
+                e.loop(F, carry)
+
+            e.loop(T, divide)
+
+            e.add(Q, ord('0'))
+            e.out(Q)
+            for cell in (Q, R, S):
+                e.clear(cell)
+            e.add(X, -1)
+
+        e.loop(X, pixel)
+
+        e.add(T, 10)
+        e.out(T)
+        e.clear(T)
+        e.add(Y, -1)
+
+    e.loop(Y, row)
+
+    return e.source()
+
+if __name__ == '__main__':
+    directory = os.path.dirname(os.path.abspath(__file__))
+
+    with open(os.path.join(directory, 'mandelbrot.b'), 'w') as f:
+        f.write(mandelbrot())
@@ -0,0 +1,10 @@
+++++++++++[>++++++++++++++++++++++++[>>[-]+<<[->>>>>>+>>>>+<<<<<<<<<<]>>
+>>>>>>>>[-<<<<<<<<<<+>>>>>>>>>>]<<<<[-<<<<+++++++>>>>]<<<<<<<[->>>>>>>+>
+>>>+<<<<<<<<<<<]>>>>>>>>>>>[-<<<<<<<<<<<+>>>>>>>>>>>]<<<<[-<<<<+++++++++
+++++>>>>]<<<[-]<<++++++++++++[>>>[-]<[->>>>>>>+>+<<<<<<<<]>>>>>>>>[-<<<<
+<<<<+>>>>>>>>]<[<<<<<<<[->+>>>>>>>+<<<<<<<<]>>>>>>>>[-<<<<<<<<+>>>>>>>>]
+<-]<<<<<<<[-]>[-<+>]<<[->+>>>>>>>+<<<<<<<<]>>>>>>>>[-<<<<<<<<+>>>>>>>>]<
+<<<<<<[->>>>+>>>+<<<<<<<]>>>>>>>[-<<<<<<<+>>>>>>>]<<<<<<<<<-]>>>>>>[-<+>
+>>>+<<<]>>>[-<<<+>>>]<<<<[->>>-------<<<<+>>>>[->>+<+<]>[-<+>]>[<<<<<<[-
+]>>>>>>[-]]<<++++++++<<<<[>>>>[-]<+<<<-]>]>>++++++++++++++++++++++++++++
+++++++++++++++++++++.[-]>[-]<<[-]<<<<<<<-]>>>>>>++++++++++.[-]<<<<<<<-]
@@ -0,0 +1,17 @@
+multiplication
+multiplies fifteen by seventeen with a copy loop forty thousand times
+and prints the low byte of the sum of all products
+
+++++++++++[>++++++++++++++++++++<-]>
+[
+    >++++++++++[>++++++++++++++++++++<-]>
+    [
+        >+++++++++++++++
+        >+++++++++++++++++
+        <[>[>+>+<<-]>>[<<+>>-]<<<-]
+        >[-]
+        <<-
+    ]
+    <<-
+]
+>>>>>.
@@ -0,0 +1,20 @@
+nested counters
+three nested loops counting to forty around a counting loop that is not
+turned into a multiplication because it steps by two
+prints the low byte of the total count
+
+++++++++++[>++++<-]>
+[
+    >++++++++++[>++++<-]>
+    [
+        >++++++++++[>++++<-]>
+        [
+            >++++++++++[>++++<-]>
+            [-->+<]
+            <<-
+        ]
+        <<-
+    ]
+    <<-
+]
+>>>>>>>.
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+
+"""
+times bf/bf.py in every execution mode and a locally compiled bf/bf.c on the benchmark programs
+
+ops are the compiled IR ops executed by the bf.py interpreter, the same count is used for every
+mode so the ops/s columns are comparable (bf.c executes more, unfolded, instructions for the same work)
+"""
+
+import argparse
+import glob
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from io import BytesIO
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(ROOT, 'bf'))
+
+import bf
+
+def count_ops(path):
+    """run the program once in-process, returns: (number of IR ops executed, output)"""
+
+    with open(path) as f:
+        program = bf.compile(f.read())
+
+    tape = bf.Tape()
+    output = BytesIO()
+    io = bf.BufferedIO(BytesIO(), output, raw=True)
+    steps = program.execute(tape, io)
+    io.flush()
+
+    return steps, output.getvalue()
+
+def build_c(directory):
+    """compile bf/bf.c, returns: the path of the binary or None if compiling failed"""
+
+    binary = os.path.join(directory, 'bf')
+    cc = os.environ.get('CC', 'cc')
+
+    try:
+        subprocess.run([cc, '-O2', '-w', '-o', binary, os.path.join(ROOT, 'bf', 'bf.c')], check=True)
+    except (OSError, subprocess.CalledProcessError) as e:
+        sys.stderr.write('not benchmarking bf.c, compiling it failed: %s\n' % e)
+        return None
+
+    return binary
+
+def time_command(command, repeat):
+    """run command repeat times, returns: (fastest wall time in seconds, output of the last run)"""
+
+    best = None
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        # bf.c returns garbage from its void main, so the exit status is ignored
+        output = subprocess.run(command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE).stdout
+        elapsed = time.perf_counter() - start
+
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best, output
+
+def main():
+    directory = os.path.dirname(os.path.abspath(__file__))
+
+    parser = argparse.ArgumentParser(description='Benchmark the brainfuck implementations')
+
+    parser.add_argument('programs', nargs='*', default=sorted(glob.glob(os.path.join(directory, '*.b'))),
+                        help='programs to run (default: all .b files next to this script)')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='runs per program and mode, the fastest one counts')
+    parser.add_argument('-m', '--modes', nargs='+', default=bf.BACKENDS + ['bf.c'], choices=bf.BACKENDS + ['bf.c'],
+                        help='execution modes to benchmark')
+    parser.add_argument('--json', metavar='FILE', type=argparse.FileType('w'),
+                        help='also write the results as JSON')
+
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        modes = {}
+        for mode in args.modes:
+            if mode == 'bf.c':
+                binary = build_c(tmp)
+                if binary is not None:
+                    modes[mode] = lambda path, binary=binary: [binary, path]
+            else:
+                modes[mode] = lambda path, mode=mode: [sys.executable, os.path.join(ROOT, 'bf', 'bf.py'),
+                                                       '--raw', '--backend', mode, path]
+
+        results = []
+        print('%-20s %-10s %12s %10s %12s' % ('program', 'mode', 'ops', 'wall (s)', 'Mops/s'))
+
+        for path in args.programs:
+            name = os.path.basename(path)
+            ops, expected = count_ops(path)
+
+            for mode, command in modes.items():
+                wall, output = time_command(command(path), args.repeat)
+
+                results.append({
+                    'program': name,
+                    'mode': mode,
+                    'ops': ops,
+                    'wall': wall,
+                    'ops_per_second': ops / wall,
+                    'output_ok': output == expected,
+                })
+
+                print('%-20s %-10s %12d %10.3f %12.2f%s' % (name, mode, ops, wall, ops / wall / 1e6,
+                                                            '' if output == expected else '  (wrong output)'))
+
+    if args.json:
+        with args.json:
+            json.dump(results, args.json, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+
+"""
+run many brainfuck program/input pairs in parallel and compare their output
+
+the manifest is a JSONL file with one case per line:
+    {"program": "path/to/program.b", "input": "...", "expected": "..."}
+optional "step_limit", "time_limit", "eof" and "cell_bits" keys override the command line defaults for that case.
+program paths are relative to the manifest.
+"""
+
+import argparse
+import bf
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+# compiled programs and error messages of programs that failed to compile by path, set up once in every
+# worker process
+programs = None
+errors = None
+
+def init_worker(compiled, failed):
+    global programs, errors
+    programs = compiled
+    errors = failed
+
+def run_case(case):
+    """run a single case in a worker, returns (status, output, seconds)"""
+
+    if case['program'] in errors:
+        return 'error: %s' % errors[case['program']], b'', 0.0
+
+    program = programs[case['program']]
+    start = time.perf_counter()
+
+    try:
+        output = program.run(case['input'].encode('utf-8'), case['step_limit'], case['cell_bits'], case['eof'],
+                             time_limit=case['time_limit'])
+    except bf.LimitExceeded as e:
+        status = 'step limit' if isinstance(e, bf.StepLimitExceeded) else 'time limit'
+        output = e.output
+    except Exception as e:
+        status = 'error: %s' % e
+        output = b''
+    else:
+        status = 'pass' if output == case['expected'].encode('utf-8') else 'fail'
+
+    return status, output, time.perf_counter() - start
+
+def load_manifest(f, defaults):
+    """read cases from a manifest file, filling in defaults for missing keys"""
+
+    base = os.path.dirname(f.name)
+    cases = []
+
+    for line in f:
+        if not line.strip():
+            continue
+
+        case = dict(defaults)
+        case.update(json.loads(line))
+        case['program'] = os.path.join(base, case['program'])
+        case.setdefault('input', '')
+        cases.append(case)
+
+    return cases
+
+def main():
+    parser = argparse.ArgumentParser(description='Run brainfuck programs against expected outputs in parallel')
+
+    parser.add_argument('manifest', type=argparse.FileType('r'),
+                        help='JSONL file of {"program", "input", "expected"} cases')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='number of worker processes (default: number of CPUs)')
+    parser.add_argument('--step-limit', type=int, default=None,
+                        help='default maximum number of steps per case')
+    parser.add_argument('--time-limit', type=float, default=None,
+                        help='default maximum number of seconds per case')
+    parser.add_argument('--eof-behaviour', '-e', dest='eof', default='unchanged', choices=['0', '-1', 'unchanged'],
+                        help='behaviour on EOF (set to 0 or -1 or leave unchanged)')
+    parser.add_argument('--cell-bits', type=int, default=8, choices=[8, 16, 32],
+                        help='width of a memory cell, values wrap around')
+    parser.add_argument('--cache-dir', metavar='DIR',
+                        help='keep compiled programs in this directory')
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help='only report failing cases and the summary')
+
+    args = parser.parse_args()
+
+    with args.manifest:
+        cases = load_manifest(args.manifest, {
+            'step_limit': args.step_limit,
+            'time_limit': args.time_limit,
+            'eof': args.eof,
+            'cell_bits': args.cell_bits,
+        })
+
+    compiled = {}
+    failed = {}
+    for path in sorted(set(case['program'] for case in cases)):
+        try:
+            with open(path) as f:
+                compiled[path] = bf.compile(f.read(), args.cache_dir)
+        except (OSError, ValueError) as e:
+            # reported for every case of the program, the other programs still run
+            failed[path] = str(e)
+
+    start = time.perf_counter()
+    passed = 0
+
+    jobs = args.jobs or os.cpu_count() or 1
+    # a few chunks per worker keeps the load balanced without one round trip per case
+    chunksize = max(1, len(cases) // (4 * jobs))
+
+    with ProcessPoolExecutor(jobs, initializer=init_worker, initargs=(compiled, failed)) as executor:
+        results = executor.map(run_case, cases, chunksize=chunksize)
+
+        for i, (case, (status, output, seconds)) in enumerate(zip(cases, results)):
+            if status == 'pass':
+                passed += 1
+                if args.quiet:
+                    continue
+
+            print('%5d %-10s %8.3fs %s' % (i, status, seconds, case['program']))
+            if status == 'fail':
+                print('      expected %r, got %r' % (case['expected'], output.decode('utf-8', 'replace')))
+
+    elapsed = time.perf_counter() - start
+
+    print('%d/%d passed in %.3fs (%.1f cases/s)' % (passed, len(cases), elapsed, len(cases) / elapsed if elapsed else 0))
+
+    sys.exit(0 if passed == len(cases) else 1)
+
+if __name__ == '__main__':
+    main()
@@ -1,71 +1,1095 @@
 #!/usr/bin/env python
 
+"""
+brainfuck interpreter
+can also be imported (with bf/ on the path):
+    bf.compile(source).run(b'input') returns the output bytes
+"""
+
 import argparse
+import builtins
+import codecs
+import hashlib
+import json
+import os
+import pickle
+import signal
+import struct
 import sys
+import time
+from array import array
+from io import BytesIO
+from types import SimpleNamespace
 
-parser = argparse.ArgumentParser(description='Run a brainfuck program')
-
-parser.add_argument('infile', metavar='program', type=argparse.FileType('r'),
-                    help='the brainfuck program to run')
-parser.add_argument('--eof-behaviour', '-e', dest='eof', default='unchanged', choices=['0', '-1', 'unchanged'],
-                    help='behaviour on EOF (set to 0 or -1 or leave unchanged)')
+# intermediate representation: a program is compiled to a list of (op, arg) tuples
+# add arg to the current cell
+ADD = 0
+# move the pointer by arg cells
+MOVE = 1
+# output the current cell
+OUT = 2
+# read into the current cell
+IN = 3
+# loop start, arg is the index of the matching CLOSE
+OPEN = 4
+# loop end, arg is the index of the matching OPEN
+CLOSE = 5
+# set the current cell to 0
+CLEAR = 6
+# add the current cell times factor to the cell at offset for every (offset, factor) in arg, then clear it
+MULADD = 7
+# move the pointer by arg cells until the current cell is 0
+SCAN = 8
 
-args = parser.parse_args()
+# ways to execute a compiled Program
+BACKENDS = ['interpret', 'codegen']
 
-p = 0
-pc = 0
-# counter to skip to the end of loops, increment on [, decrement on ] (done when 0)
-seek_loop_end = 0
-# program counter locations for loop beginnings
-loops = []
-memory = {}
+OP_NAMES = ['ADD', 'MOVE', 'OUT', 'IN', 'OPEN', 'CLOSE', 'CLEAR', 'MULADD', 'SCAN']
 
-with args.infile:
-    program = args.infile.read()
+def match_brackets(program):
+    """
+    pair up all [ and ] in program
+    returns: dict mapping the position of every bracket to the position of its partner
+    """
 
-while pc < len(program):
-    # the current command
-    c = program[pc]
-    pc += 1
+    jumps = {}
+    # positions of the [s that have not been closed yet
+    opened = []
 
-    # we need to search for a ], when seek_loop_count reaches 0 we're there
-    if seek_loop_end > 0:
+    for pos, c in enumerate(program):
         if c == '[':
-            seek_loop_end += 1
+            opened.append(pos)
         elif c == ']':
-            seek_loop_end -= 1
-
-        continue
-
-    if c == '<':
-        p -= 1
-    elif c == '>':
-        p += 1
-    elif c == '-':
-        memory[p] = memory.get(p, 0) - 1
-    elif c == '+':
-        memory[p] = memory.get(p, 0) + 1
-    elif c == '.':
-        sys.stdout.write(chr(memory[p]))
-    elif c == ',':
-        in_c = sys.stdin.read(1)
-        if in_c:
-            in_c = ord(in_c)
+            if not opened:
+                raise ValueError('unmatched ] at position %d' % pos)
+            start = opened.pop()
+            jumps[start] = pos
+            jumps[pos] = start
+
+    if opened:
+        raise ValueError('unmatched [ at position %d' % opened[-1])
+
+    return jumps
+
+def simplify_loop(body):
+    """
+    try to replace the ops of a loop body with a single op
+    returns: the replacement op, or None if the loop has to stay a loop
+    """
+
+    if len(body) == 1 and body[0][0] == ADD and body[0][1] in (-1, 1):
+        # [-] and [+]
+        return (CLEAR, None)
+
+    if len(body) == 1 and body[0][0] == MOVE:
+        # [>], [<<] etc.
+        return (SCAN, body[0][1])
+
+    # multiply loop: only ADDs and MOVEs, ends where it started and decrements the start cell by one
+    offset = 0
+    changes = {}
+    for op, arg in body:
+        if op == ADD:
+            changes[offset] = changes.get(offset, 0) + arg
+        elif op == MOVE:
+            offset += arg
+        else:
+            return None
+
+    if offset != 0 or changes.pop(0, 0) != -1:
+        return None
+
+    return (MULADD, tuple((off, factor) for off, factor in changes.items() if factor != 0))
+
+def compile_program(program, positions=None):
+    """
+    compile brainfuck source to a list of (op, arg) tuples
+    folds runs of +-<>, and turns clear, multiply and scan loops into single ops
+    positions: if given, a list that gets the source (line, column) of every op
+    """
+
+    # raises for unbalanced brackets, with positions in the original source
+    match_brackets(program)
+
+    ops = []
+    if positions is None:
+        positions = []
+    # indices of the OPENs that have not been closed yet
+    opened = []
+    line = 1
+    col = 0
+
+    for c in program:
+        col += 1
+
+        if c == '\n':
+            line += 1
+            col = 0
+        elif c in '+-<>':
+            op = ADD if c in '+-' else MOVE
+            amount = 1 if c in '+>' else -1
+
+            if ops and ops[-1][0] == op:
+                amount += ops[-1][1]
+                if amount:
+                    ops[-1] = (op, amount)
+                else:
+                    del ops[-1]
+                    del positions[-1]
+            else:
+                ops.append((op, amount))
+                positions.append((line, col))
+        elif c in '.,[':
+            if c == '[':
+                opened.append(len(ops))
+            ops.append(({'.': OUT, ',': IN, '[': OPEN}[c], None))
+            positions.append((line, col))
+        elif c == ']':
+            start = opened.pop()
+
+            replacement = simplify_loop(ops[start+1:])
+            if replacement is not None:
+                # the replacement keeps the position of the [
+                del ops[start:]
+                del positions[start+1:]
+                ops.append(replacement)
+            else:
+                ops[start] = (OPEN, len(ops))
+                ops.append((CLOSE, start))
+                positions.append((line, col))
+
+    return ops
+
+class LimitExceeded(Exception):
+    """raised when a program runs for longer than allowed"""
+
+    def __init__(self, message, steps, pc):
+        super().__init__(message)
+        self.steps = steps
+        # index of the next op to execute, the tape pointer is saved in the Tape
+        self.pc = pc
+        # output produced until the limit was hit, set by Program.run
+        self.output = None
+
+class StepLimitExceeded(LimitExceeded):
+    def __init__(self, steps, pc):
+        super().__init__('step limit exceeded after %d steps' % steps, steps, pc)
+
+class TimeLimitExceeded(LimitExceeded):
+    def __init__(self, steps, pc):
+        super().__init__('time limit exceeded after %d steps' % steps, steps, pc)
+
+class InputRequired(LimitExceeded):
+    """raised instead of reading input when running only the input-independent part of a program"""
+
+    def __init__(self, steps, pc):
+        super().__init__('stopped before reading input after %d steps' % steps, steps, pc)
+
+class Tape:
+    """
+    contiguous memory of fixed-width cells that grows in both directions
+    like mem_pos/mem_neg in bf.c, but in a single buffer: cell 0 lives at index origin
+    pointer is the index of the current cell while no program is running on the tape
+    """
+
+    def __init__(self, cell_bits=8, size=1024):
+        if cell_bits == 8:
+            self.typecode = None
+        else:
+            typecodes = [tc for tc in 'BHIL' if array(tc).itemsize * 8 == cell_bits]
+            if not typecodes:
+                raise ValueError('unsupported cell width: %r' % (cell_bits,))
+            self.typecode = typecodes[0]
+
+        self.cell_bits = cell_bits
+        self.mask = (1 << cell_bits) - 1
+        self.cells = self.zeros(size)
+        self.origin = 0
+        self.pointer = 0
+
+    def zeros(self, n):
+        """return n zero cells in the buffer type of this tape"""
+
+        if self.typecode is None:
+            return bytearray(n)
+        return array(self.typecode, bytes(n * array(self.typecode).itemsize))
+
+    def snapshot(self):
+        """returns: the state of the tape as plain data, for restore()"""
+
+        return (self.cell_bits, bytes(self.cells), self.origin, self.pointer)
+
+    def restore(self, state):
+        """replace the contents of the tape with a snapshot() of a tape with the same cell width"""
+
+        cell_bits, data, self.origin, self.pointer = state
+
+        if cell_bits != self.cell_bits:
+            raise ValueError('snapshot has %d bit cells, tape has %d bit cells' % (cell_bits, self.cell_bits))
+
+        self.cells = bytearray(data) if self.typecode is None else array(self.typecode, data)
+
+    def grow(self, p, margin=0):
+        """
+        grow the buffer in place until the indices p-margin to p+margin are valid
+        returns: the index of the same cell after growing (it changes if cells are added at the front)
+        """
+
+        cells = self.cells
+
+        if p - margin < 0:
+            n = max(len(cells), margin - p)
+            cells[0:0] = self.zeros(n)
+            self.origin += n
+            p += n
+
+        if p + margin >= len(cells):
+            cells.extend(self.zeros(max(len(cells), p + margin + 1 - len(cells))))
+
+        return p
+
+    def scan(self, p, step, margin=0):
+        """
+        move from index p in steps of step until a zero cell is found, searching with bytearray.find and slices
+        returns: the index of the zero cell (growing the tape if it is outside of the buffer)
+        """
+
+        cells = self.cells
+
+        if self.typecode is None and step == 1:
+            p = cells.find(0, p)
+            if p < 0:
+                p = len(cells)
+        elif self.typecode is None and step == -1:
+            # -1 if not found, which is the next cell to the left
+            p = cells.rfind(0, 0, p + 1)
+        else:
+            # search strided slices of growing size, so zeros close by are found without copying the whole tape
+            size = 64
+            while True:
+                stop = p + step * size
+                part = cells[p:stop if stop >= 0 else None:step]
+
+                if self.typecode is None:
+                    found = part.find(0)
+                else:
+                    try:
+                        found = part.index(0)
+                    except ValueError:
+                        found = -1
+
+                if found >= 0:
+                    p += found * step
+                    break
+
+                p += len(part) * step
+                if not 0 <= p < len(cells):
+                    break
+                size *= 4
+
+        if p < margin or p + margin >= len(cells):
+            p = self.grow(p, margin)
+
+        return p
+
+class BufferedIO:
+    """
+    program input and output on binary streams
+    input is read in blocks and output is collected and written in bulk
+    in raw mode cells are read and written as single bytes, otherwise as utf-8 encoded characters
+    """
+
+    def __init__(self, infile, outfile, eof='unchanged', mask=0xff, raw=False, flush_threshold=1 << 16, block_size=1 << 16):
+        """
+        eof: behaviour on EOF ('0', '-1' or 'unchanged')
+        mask: all-ones value of a cell, input values are truncated to it
+        flush_threshold: write the output once this many bytes are pending (0 to write every character)
+        """
+
+        self.read_block = getattr(infile, 'read1', infile.read)
+        self.outfile = outfile
+        self.eof = eof
+        self.mask = mask
+        self.raw = raw
+        self.flush_threshold = flush_threshold
+        self.block_size = block_size
+
+        self.decoder = None if raw else codecs.getincrementaldecoder('utf-8')('replace')
+        self.inbuf = b''
+        self.inpos = 0
+        # bytes read from infile so far, and the raw bytes behind inbuf with their offset and the decoder
+        # state before them, to find out how much of the input was consumed, see consumed()
+        self.bytes_read = 0
+        self.block = b''
+        self.block_offset = 0
+        self.block_state = (b'', 0)
+        self.outbuf = bytearray()
+        # cell value -> utf-8 bytes, for text mode
+        self.encoded = {}
+
+    def write(self, value):
+        """output a cell value"""
+
+        if self.raw:
+            self.outbuf.append(value & 0xff)
+        else:
+            encoded = self.encoded.get(value)
+            if encoded is None:
+                encoded = chr(value).encode('utf-8', 'replace') if value <= sys.maxunicode else '\ufffd'.encode('utf-8')
+                self.encoded[value] = encoded
+            self.outbuf += encoded
+
+        if len(self.outbuf) >= self.flush_threshold:
+            self.flush()
+
+    def flush(self):
+        """write all pending output"""
+
+        if self.outbuf:
+            self.outfile.write(self.outbuf)
+            self.outbuf.clear()
+        self.outfile.flush()
+
+    def read(self, value):
+        """
+        read the next input value
+        value: the current cell value, returned unchanged on EOF in 'unchanged' mode
+        """
+
+        if self.inpos >= len(self.inbuf) and not self.fill():
+            if self.eof == '0':
+                return 0
+            elif self.eof == '-1':
+                return self.mask
+            return value
+
+        c = self.inbuf[self.inpos]
+        self.inpos += 1
+
+        return (c if self.raw else ord(c)) & self.mask
+
+    def fill(self):
+        """read the next block of input, returns False on EOF"""
+
+        # show any prompt before waiting for input
+        self.flush()
+
+        while True:
+            raw_block = self.read_block(self.block_size)
+            offset = self.bytes_read
+            self.bytes_read += len(raw_block)
+
+            block = raw_block
+            if self.decoder is not None:
+                state = self.decoder.getstate()
+                block = self.decoder.decode(raw_block, final=not raw_block)
+                if not block and self.decoder.getstate()[0]:
+                    # only part of a multibyte character so far
+                    continue
+
+            if not block:
+                return False
+
+            self.inbuf = block
+            self.inpos = 0
+            self.block = raw_block
+            self.block_offset = offset
+            if self.decoder is not None:
+                self.block_state = state
+
+            return True
+
+    def consumed(self):
+        """number of input bytes read() has used up, input read ahead into the buffer doesn't count"""
+
+        if self.decoder is None:
+            return self.block_offset + self.inpos
+
+        # bytes of a character started in the previous block
+        pending = len(self.block_state[0])
+        if not self.inpos:
+            return self.block_offset - pending
+
+        # decode the block again byte by byte until it yields the characters used so far. with invalid
+        # input, a byte can complete a replacement character and also start or be the next character
+        decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        decoder.setstate(self.block_state)
+        chars = 0
+        for i in range(len(self.block)):
+            chars += len(decoder.decode(self.block[i:i+1]))
+            if chars >= self.inpos:
+                return self.block_offset + i + 1 - len(decoder.getstate()[0]) - (chars - self.inpos)
+
+        return self.bytes_read
+
+    def skip(self, count):
+        """discard the first count bytes of input, returns False if the input ends before"""
+
+        while self.bytes_read < count:
+            block = self.read_block(min(self.block_size, count - self.bytes_read))
+            if not block:
+                return False
+            self.bytes_read += len(block)
+
+        self.block_offset = self.bytes_read
+
+        return True
+
+def reach(ops):
+    """the furthest offset a MULADD in ops touches, the tape needs this many cells around the pointer"""
+
+    return max((abs(offset) for op, arg in ops if op == MULADD for offset, factor in arg), default=0)
+
+# number of steps between clock checks when running with a time limit
+TIME_CHECK_INTERVAL = 1 << 16
+
+def run(ops, tape, io, step_limit=None, time_limit=None, stop_before_input=False, pc=0, checkpoint=None):
+    """
+    execute compiled ops on a Tape, starting at op pc and the current cell of the tape
+    input and output go through a BufferedIO
+    step_limit: raise StepLimitExceeded after this many ops
+    time_limit: raise TimeLimitExceeded after this many seconds
+    both limits are checked at the end of loops
+    stop_before_input: raise InputRequired instead of reading input
+    checkpoint: called as checkpoint(steps, pc) with the tape pointer saved, at the end of a loop
+        every TIME_CHECK_INTERVAL steps, it decides itself when to save the state
+    returns: the number of ops executed
+    """
+
+    if step_limit is None:
+        step_limit = float('inf')
+    deadline = None if time_limit is None else time.monotonic() + time_limit
+
+    def check_limits(steps, pc, p):
+        """raise if a limit is exceeded and offer a checkpoint, returns: the step count at which to check again"""
+
+        if steps > step_limit:
+            raise StepLimitExceeded(steps, pc)
+        if deadline is None and checkpoint is None:
+            return step_limit
+
+        if deadline is not None and time.monotonic() > deadline:
+            raise TimeLimitExceeded(steps, pc)
+        if checkpoint is not None:
+            tape.pointer = p
+            checkpoint(steps, pc)
+
+        return min(step_limit, steps + TIME_CHECK_INTERVAL)
+
+    check_at = check_limits(0, pc, tape.pointer)
+
+    cells = tape.cells
+    mask = tape.mask
+    margin = reach(ops)
+    write = io.write
+    read = io.read
+    p = tape.grow(tape.pointer, margin)
+    steps = 0
+
+    try:
+        while pc < len(ops):
+            op, arg = ops[pc]
+            pc += 1
+            steps += 1
+
+            if op == ADD:
+                cells[p] = (cells[p] + arg) & mask
+            elif op == MOVE:
+                p += arg
+                if p < margin or p + margin >= len(cells):
+                    p = tape.grow(p, margin)
+            elif op == OPEN:
+                # current cell is 0, skip the loop
+                if cells[p] == 0:
+                    pc = arg + 1
+            elif op == CLOSE:
+                # current cell is not 0, go back to the start of the loop body
+                if cells[p] != 0:
+                    pc = arg + 1
+                    if steps > check_at:
+                        check_at = check_limits(steps, pc, p)
+            elif op == CLEAR:
+                cells[p] = 0
+            elif op == MULADD:
+                value = cells[p]
+                if value != 0:
+                    for offset, factor in arg:
+                        cells[p+offset] = (cells[p+offset] + value * factor) & mask
+                    cells[p] = 0
+            elif op == SCAN:
+                if cells[p] != 0:
+                    p = tape.scan(p, arg, margin)
+            elif op == OUT:
+                write(cells[p])
+            elif op == IN:
+                if stop_before_input:
+                    raise InputRequired(steps - 1, pc - 1)
+                cells[p] = read(cells[p])
+    finally:
+        # the pointer can be saved even if the run is interrupted
+        tape.pointer = p
+
+    return steps
+
+def run_profiled(ops, tape, io, counts):
+    """
+    execute compiled ops like run(), counting every op that runs
+    counts: list with one counter per op, incremented in place (so it is filled even if the run is interrupted)
+    """
+
+    cells = tape.cells
+    mask = tape.mask
+    margin = reach(ops)
+    p = tape.grow(tape.pointer, margin)
+    pc = 0
+
+    while pc < len(ops):
+        op, arg = ops[pc]
+        counts[pc] += 1
+        pc += 1
+
+        if op == ADD:
+            cells[p] = (cells[p] + arg) & mask
+        elif op == MOVE:
+            p += arg
+            if p < margin or p + margin >= len(cells):
+                p = tape.grow(p, margin)
+        elif op == OPEN:
+            if cells[p] == 0:
+                pc = arg + 1
+        elif op == CLOSE:
+            if cells[p] != 0:
+                pc = arg + 1
+        elif op == CLEAR:
+            cells[p] = 0
+        elif op == MULADD:
+            value = cells[p]
+            if value != 0:
+                for offset, factor in arg:
+                    cells[p+offset] = (cells[p+offset] + value * factor) & mask
+                cells[p] = 0
+        elif op == SCAN:
+            if cells[p] != 0:
+                p = tape.scan(p, arg, margin)
+        elif op == OUT:
+            io.write(cells[p])
+        elif op == IN:
+            cells[p] = io.read(cells[p])
+
+def profile_data(ops, positions, counts):
+    """
+    summarize op counts from run_profiled()
+    returns: dict with the counts per op, per loop and per loop nesting (as flamegraph stacks)
+    """
+
+    data = {'total': sum(counts), 'ops': [], 'loops': [], 'stacks': []}
+
+    for i, ((op, arg), (line, col), count) in enumerate(zip(ops, positions, counts)):
+        data['ops'].append({'index': i, 'op': OP_NAMES[op], 'line': line, 'column': col, 'count': count})
+
+        if op == OPEN:
+            # every iteration runs the first op of the body (or the CLOSE of an empty loop) once
+            data['loops'].append({
+                'line': line,
+                'column': col,
+                'entries': count,
+                'iterations': counts[i + 1],
+                'steps': sum(counts[i:arg + 1]),
+            })
+
+    # steps spent directly in every loop nesting, outermost loop first
+    stacks = {}
+    frames = ['main']
+    for (op, arg), (line, col), count in zip(ops, positions, counts):
+        if op == OPEN:
+            frames.append('loop@%d:%d' % (line, col))
+
+        key = tuple(frames)
+        stacks[key] = stacks.get(key, 0) + count
+
+        if op == CLOSE:
+            frames.pop()
+
+    data['stacks'] = [{'stack': list(key), 'count': count} for key, count in stacks.items() if count]
+
+    return data
+
+def profile_report(data, top=20):
+    """format profile_data() as a text report of the hottest ops and loops"""
+
+    total = data['total'] or 1
+    out = ['%d ops executed' % data['total'], '']
+
+    by_op = {}
+    for entry in data['ops']:
+        by_op[entry['op']] = by_op.get(entry['op'], 0) + entry['count']
+    out.append('by op:')
+    for name, count in sorted(by_op.items(), key=lambda item: -item[1]):
+        out.append('  %-8s %12d %6.2f%%' % (name, count, 100 * count / total))
+
+    out += ['', 'hot loops (steps include nested loops):',
+            '  %-10s %12s %12s %10s %12s %7s' % ('location', 'entries', 'iterations', 'avg', 'steps', '')]
+    for loop in sorted(data['loops'], key=lambda loop: -loop['steps'])[:top]:
+        out.append('  %-10s %12d %12d %10.1f %12d %6.2f%%' % (
+            '%d:%d' % (loop['line'], loop['column']), loop['entries'], loop['iterations'],
+            loop['iterations'] / loop['entries'] if loop['entries'] else 0,
+            loop['steps'], 100 * loop['steps'] / total))
+
+    out += ['', 'hot ops (CLEAR, MULADD and SCAN are optimized loops):']
+    for entry in sorted(data['ops'], key=lambda entry: -entry['count'])[:top]:
+        if not entry['count']:
+            break
+        out.append('  %-10s %-8s %12d %6.2f%%' % (
+            '%d:%d' % (entry['line'], entry['column']), entry['op'], entry['count'], 100 * entry['count'] / total))
+
+    return '\n'.join(out) + '\n'
+
+def generate_python(ops):
+    """
+    translate compiled ops to the source of a python function _bf_main(tape, write, read)
+    write: called with every output value
+    read: called with the current cell value, returns the new value
+    """
+
+    # loops nested deeper than this are moved to helper functions (python allows only 20 nested blocks)
+    max_depth = 16
+    # helper functions, innermost first so they are defined before they are used
+    functions = []
+
+    def block(start, end, indent, depth):
+        lines = []
+
+        def emit(line):
+            lines.append('    ' * indent + line)
+
+        pc = start
+        while pc < end:
+            op, arg = ops[pc]
+
+            if op == ADD:
+                emit('cells[p] = (cells[p] + %d) & mask' % arg)
+            elif op == MOVE:
+                emit('p += %d' % arg)
+                emit('if p < margin or p + margin >= len(cells):')
+                emit('    p = grow(p, margin)')
+            elif op == OPEN:
+                if depth < max_depth:
+                    emit('while cells[p]:')
+                    lines += block(pc + 1, arg, indent + 1, depth + 1) or ['    ' * (indent + 1) + 'pass']
+                else:
+                    name = '_loop_%d' % pc
+                    functions.append(['    def %s(p):' % name, '        while cells[p]:']
+                                     + (block(pc + 1, arg, 3, 1) or ['            pass'])
+                                     + ['        return p'])
+                    emit('p = %s(p)' % name)
+                pc = arg
+            elif op == CLEAR:
+                emit('cells[p] = 0')
+            elif op == MULADD:
+                emit('value = cells[p]')
+                emit('if value:')
+                for offset, factor in arg:
+                    emit('    cells[p+%d] = (cells[p+%d] + value * %d) & mask' % (offset, offset, factor))
+                emit('    cells[p] = 0')
+            elif op == SCAN:
+                emit('if cells[p]:')
+                emit('    p = scan(p, %d, margin)' % arg)
+            elif op == OUT:
+                emit('write(cells[p])')
+            elif op == IN:
+                emit('cells[p] = read(cells[p])')
+
+            pc += 1
+
+        return lines
+
+    body = block(0, len(ops), 1, 0)
+
+    lines = [
+        'def _bf_main(tape, write, read):',
+        '    cells = tape.cells',
+        '    mask = tape.mask',
+        '    grow = tape.grow',
+        '    scan = tape.scan',
+        '    margin = %d' % reach(ops),
+        '    p = grow(tape.pointer, margin)',
+    ]
+    for function in functions:
+        lines += function
+    lines += body
+
+    return '\n'.join(lines) + '\n'
+
+def generate_function(ops):
+    """compile the source from generate_python(ops) and return the _bf_main function"""
+
+    namespace = {}
+    exec(builtins.compile(generate_python(ops), '<bf codegen>', 'exec'), namespace)
+    return namespace['_bf_main']
+
+def run_codegen(ops, tape, io):
+    """execute compiled ops on a Tape by generating python source and running it, with input and output through a BufferedIO"""
+
+    generate_function(ops)(tape, io.write, io.read)
+
+# checkpoint files: header, followed by the raw tape cells
+CHECKPOINT_MAGIC = b'BFCK'
+CHECKPOINT_VERSION = 2
+# magic, version, cell bits, ops digest, steps, pc, bytes of input consumed, origin, pointer,
+# length of the tape data in bytes
+CHECKPOINT_HEADER = struct.Struct('<4sBB32sQQQQQQ')
+
+def ops_digest(ops):
+    """hash of compiled ops, so checkpoints are only resumed by the program that wrote them"""
+
+    return hashlib.sha256(repr(ops).encode('utf-8')).digest()
+
+def save_checkpoint(path, ops, tape, pc, steps, consumed=0):
+    """
+    write the state of ops running on tape, about to execute op pc after steps ops, to path
+    consumed: number of input bytes used so far, a resumed run skips them (see BufferedIO.consumed())
+    """
+
+    cell_bits, data, origin, pointer = tape.snapshot()
+    header = CHECKPOINT_HEADER.pack(CHECKPOINT_MAGIC, CHECKPOINT_VERSION, cell_bits, ops_digest(ops),
+                                    steps, pc, consumed, origin, pointer, len(data))
+
+    # write to a temporary file first, so an interruption never leaves a broken checkpoint
+    tmp_path = '%s.tmp' % path
+    with open(tmp_path, 'wb') as f:
+        f.write(header)
+        f.write(data)
+    os.replace(tmp_path, path)
+
+def load_checkpoint(path, ops):
+    """
+    read a checkpoint written by save_checkpoint() for the same ops
+    returns: (Tape, pc, steps, consumed)
+    """
+
+    with open(path, 'rb') as f:
+        header = f.read(CHECKPOINT_HEADER.size)
+        if len(header) != CHECKPOINT_HEADER.size:
+            raise ValueError('truncated checkpoint header')
+
+        magic, version, cell_bits, digest, steps, pc, consumed, origin, pointer, length = \
+            CHECKPOINT_HEADER.unpack(header)
+        if magic != CHECKPOINT_MAGIC or version != CHECKPOINT_VERSION:
+            raise ValueError('not a checkpoint (or an unsupported version)')
+        if digest != ops_digest(ops):
+            raise ValueError('checkpoint was written by a different program')
+
+        data = f.read(length)
+        if len(data) != length:
+            raise ValueError('truncated checkpoint data')
+
+    tape = Tape(cell_bits)
+    tape.restore((cell_bits, data, origin, pointer))
+
+    return tape, pc, steps, consumed
+
+def link(ops):
+    """returns: ops with the targets of all OPENs and CLOSEs recomputed from their nesting"""
+
+    ops = list(ops)
+    opened = []
+
+    for i, (op, arg) in enumerate(ops):
+        if op == OPEN:
+            opened.append(i)
+        elif op == CLOSE:
+            start = opened.pop()
+            ops[start] = (OPEN, i)
+            ops[i] = (CLOSE, start)
+
+    return ops
+
+def residual(ops, positions, pc):
+    """
+    ops that continue the execution of ops at op pc, as a program starting at index 0:
+    the rest of the body of every loop around pc, followed by that whole loop, innermost loop first
+    returns: (ops, positions)
+    """
+
+    # OPENs of the loops around pc
+    around = []
+    for i, (op, arg) in enumerate(ops[:pc]):
+        if op == OPEN:
+            around.append(i)
+        elif op == CLOSE:
+            around.pop()
+
+    new_ops = []
+    new_positions = []
+    for start in reversed(around):
+        end = ops[start][1]
+        new_ops += ops[pc:end] + ops[start:end + 1]
+        new_positions += positions[pc:end] + positions[start:end + 1]
+        pc = end + 1
+
+    new_ops += ops[pc:]
+    new_positions += positions[pc:]
+
+    return link(new_ops), new_positions
+
+class Program:
+    """a compiled brainfuck program, returned by compile()"""
+
+    def __init__(self, ops, positions=None, start=None):
+        """
+        start: (tape snapshot, output values) to begin execution from, see precompute()
+        """
+
+        self.ops = ops
+        # source (line, column) of every op
+        self.positions = positions
+        self.start = start
+        # generated _bf_main function, created on the first codegen run
+        self.function = None
+
+    def execute(self, tape, io, backend='interpret', step_limit=None, time_limit=None, counts=None,
+                resume=None, checkpoint=None):
+        """
+        run the program on a Tape, with input and output through a BufferedIO
+        counts: if given, run with run_profiled() and count executed ops in it
+        resume: continue a run at this pc with the tape as it is (see load_checkpoint())
+        checkpoint: called regularly as checkpoint(steps, pc) to save the state (interpreter only, see run())
+        returns: the number of ops executed (None for the codegen backend and profiling)
+        """
+
+        if resume is None:
+            resume = 0
+            if self.start is not None:
+                state, output = self.start
+                tape.restore(state)
+                for value in output:
+                    io.write(value)
+
+        if counts is not None:
+            if resume:
+                raise ValueError('profiling a resumed run is not supported')
+            run_profiled(self.ops, tape, io, counts)
+        elif backend == 'codegen':
+            if step_limit is not None or time_limit is not None or checkpoint is not None:
+                raise ValueError('limits and checkpoints are only supported by the interpreter backend')
+
+            if resume:
+                generate_function(residual(self.ops, self.positions, resume)[0])(tape, io.write, io.read)
+            else:
+                if self.function is None:
+                    self.function = generate_function(self.ops)
+                self.function(tape, io.write, io.read)
+        elif backend == 'interpret':
+            return run(self.ops, tape, io, step_limit, time_limit, pc=resume, checkpoint=checkpoint)
         else:
-            if args.eof == '0':
-                in_c = 0
-            elif args.eof == '-1':
-                in_c = -1
-            elif args.eof == 'unchanged':
-                in_c = memory[p]
-
-        memory[p] = in_c
-    elif c == '[':
-        # current cell is 0, skip the loop
-        if memory.get(p, 0) == 0:
-            seek_loop_end = 1
+            raise ValueError('unknown backend: %r' % (backend,))
+
+    def run(self, input=b'', step_limit=None, cell_bits=8, eof='unchanged', backend='interpret', time_limit=None):
+        """
+        run the program on input bytes, reading and writing one byte per cell
+        step_limit: raise StepLimitExceeded after this many ops
+        time_limit: raise TimeLimitExceeded after this many seconds
+        the output attribute of a LimitExceeded holds the output until the limit was hit
+        returns: the output bytes
+        """
+
+        tape = Tape(cell_bits)
+        output = BytesIO()
+        io = BufferedIO(BytesIO(input), output, eof, tape.mask, raw=True, flush_threshold=sys.maxsize)
+
+        try:
+            self.execute(tape, io, backend, step_limit, time_limit)
+        except LimitExceeded as e:
+            io.flush()
+            e.output = output.getvalue()
+            raise
+
+        io.flush()
+        return output.getvalue()
+
+    def precompute(self, step_limit, cell_bits=8):
+        """
+        partially evaluate the program: run it until it first reads input, or for about step_limit steps
+        returns: a Program that starts with the output and tape of that run and continues from there
+        """
+
+        if self.start is not None:
+            raise ValueError('program is already precomputed')
+
+        tape = Tape(cell_bits)
+        output = []
+
+        try:
+            run(self.ops, tape, SimpleNamespace(write=output.append, read=None), step_limit, stop_before_input=True)
+        except (StepLimitExceeded, InputRequired) as e:
+            pc = e.pc
         else:
-            # push the location of the [ to the loop stack for later backtracking
-            loops.append(pc - 1)
-    elif c == ']':
-        pc = loops.pop()
+            pc = len(self.ops)
+
+        ops, positions = residual(self.ops, self.positions or [(0, 0)] * len(self.ops), pc)
+
+        return Program(ops, positions, (tape.snapshot(), output))
+
+    def __getstate__(self):
+        # functions can't be pickled, workers and caches regenerate it
+        return {'ops': self.ops, 'positions': self.positions, 'start': self.start, 'function': None}
+
+# bump when the IR changes, so stale cache entries are ignored
+CACHE_VERSION = 3
+
+def compile(source, cache_dir=None, precompute=None, cell_bits=8):
+    """
+    compile brainfuck source to a Program
+    cache_dir: directory to keep compiled programs in, keyed by a hash of the source and options
+    precompute: if given, run the program until it reads input or for about this many steps
+        and start every run from there (see Program.precompute), only valid for cells of cell_bits
+    """
+
+    def build():
+        positions = []
+        program = Program(compile_program(source, positions), positions)
+        if precompute is not None:
+            program = program.precompute(precompute, cell_bits)
+        return program
+
+    if cache_dir is None:
+        return build()
+
+    options = '%d:%r:%d:' % (CACHE_VERSION, precompute, cell_bits)
+    key = hashlib.sha256(options.encode('utf-8') + source.encode('utf-8')).hexdigest()
+    path = os.path.join(cache_dir, 'bf-%s.pickle' % key)
+
+    try:
+        with open(path, 'rb') as f:
+            return Program(*pickle.load(f))
+    except (OSError, pickle.UnpicklingError, EOFError, ValueError):
+        pass
+
+    program = build()
+
+    os.makedirs(cache_dir, exist_ok=True)
+    # write to a temporary file first so concurrent runs never see half a program
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        pickle.dump((program.ops, program.positions, program.start), f, pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+    return program
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a brainfuck program')
+
+    parser.add_argument('infile', metavar='program', type=argparse.FileType('r'),
+                        help='the brainfuck program to run')
+    parser.add_argument('--eof-behaviour', '-e', dest='eof', default='unchanged', choices=['0', '-1', 'unchanged'],
+                        help='behaviour on EOF (set to 0 or -1 or leave unchanged)')
+    parser.add_argument('--backend', '-b', default='interpret', choices=BACKENDS,
+                        help='run the compiled program in the interpreter loop or translate it to python first')
+    parser.add_argument('--cell-bits', type=int, default=8, choices=[8, 16, 32],
+                        help='width of a memory cell, values wrap around')
+    parser.add_argument('--raw', action='store_true',
+                        help='read and write single bytes instead of utf-8 encoded characters')
+    parser.add_argument('--unbuffered', '-u', action='store_true',
+                        help='write every output character immediately (for interactive use)')
+    parser.add_argument('--flush-threshold', type=int, default=1 << 16, metavar='BYTES',
+                        help='write the output once this many bytes are pending')
+    parser.add_argument('--cache-dir', metavar='DIR',
+                        help='keep compiled programs in this directory')
+    parser.add_argument('--precompute', type=int, metavar='STEPS',
+                        help='run the program up to its first input (at most about STEPS ops) when compiling it, '
+                             'and start from there (cached with --cache-dir)')
+    parser.add_argument('--checkpoint', metavar='FILE',
+                        help='save the state of the run to FILE regularly and when interrupted by SIGINT/SIGTERM '
+                             '(removed when the program ends)')
+    parser.add_argument('--checkpoint-interval', type=float, default=60, metavar='SECONDS',
+                        help='time between checkpoints')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue the run saved in the --checkpoint file, with the same input on stdin '
+                             '(the part the saved run already read is skipped)')
+    parser.add_argument('--profile', action='store_true',
+                        help='count executed ops and print a report of the hottest loops to stderr')
+    parser.add_argument('--profile-json', metavar='FILE', type=argparse.FileType('w'),
+                        help='write the profile data as JSON (implies --profile)')
+
+    args = parser.parse_args()
+
+    with args.infile:
+        program = args.infile.read()
+
+    try:
+        program = compile(program, args.cache_dir, args.precompute, args.cell_bits)
+    except ValueError as e:
+        parser.exit(1, 'error: %s\n' % e)
+
+    resume = None
+    steps_before = 0
+    consumed = 0
+
+    if args.checkpoint is not None and args.backend != 'interpret' and not args.resume:
+        parser.error('--checkpoint needs the interpreter backend')
+    if (args.profile or args.profile_json) and (args.checkpoint is not None or args.resume):
+        # a profile of part of a run would be misleading, and the profiler doesn't save checkpoints
+        parser.error('--profile can\'t be combined with --checkpoint or --resume')
+
+    if args.resume:
+        if args.checkpoint is None:
+            parser.error('--resume needs --checkpoint')
+
+        try:
+            tape, resume, steps_before, consumed = load_checkpoint(args.checkpoint, program.ops)
+        except (OSError, ValueError) as e:
+            parser.exit(1, 'error: can\'t resume from %s: %s\n' % (args.checkpoint, e))
+    else:
+        tape = Tape(args.cell_bits)
+
+    io = BufferedIO(sys.stdin.buffer, sys.stdout.buffer, args.eof, tape.mask, args.raw,
+                    0 if args.unbuffered else args.flush_threshold)
+
+    if not io.skip(consumed):
+        parser.exit(1, 'error: the input ends before byte %d, where the checkpointed run stopped reading\n' % consumed)
+
+    checkpoint = None
+    if args.checkpoint is not None and args.backend == 'interpret':
+        next_checkpoint = time.monotonic() + args.checkpoint_interval
+        interrupted = []
+
+        def interrupt(signum, frame):
+            # stop at the next checkpoint, where the state is consistent
+            interrupted.append(signum)
+
+        signal.signal(signal.SIGINT, interrupt)
+        signal.signal(signal.SIGTERM, interrupt)
+
+        def checkpoint(steps, pc):
+            global next_checkpoint
+
+            if interrupted or time.monotonic() >= next_checkpoint:
+                # output written before the checkpoint must not be repeated after resuming
+                io.flush()
+                save_checkpoint(args.checkpoint, program.ops, tape, pc, steps_before + steps, io.consumed())
+                next_checkpoint = time.monotonic() + args.checkpoint_interval
+
+            if interrupted:
+                raise SystemExit('interrupted after reading %d bytes of input, state saved to %s' % (
+                    io.consumed(), args.checkpoint))
+
+    if args.profile or args.profile_json:
+        counts = [0] * len(program.ops)
+        try:
+            program.execute(tape, io, counts=counts)
+        finally:
+            io.flush()
+
+            data = profile_data(program.ops, program.positions, counts)
+            sys.stderr.write(profile_report(data))
+            if args.profile_json:
+                with args.profile_json:
+                    json.dump(data, args.profile_json)
+    else:
+        try:
+            program.execute(tape, io, args.backend, resume=resume, checkpoint=checkpoint)
+        finally:
+            io.flush()
+
+        if args.checkpoint is not None and os.path.exists(args.checkpoint):
+            os.remove(args.checkpoint)
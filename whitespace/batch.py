@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+
+"""
+run a whitespace program against many input/expected output pairs in parallel
+
+the cases file is a JSONL file with one case per line:
+    {"input": "...", "expected": "..."}
+optional "step_limit" and "time_limit" keys override the command line defaults for that case.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+import whitespace
+from concurrent.futures import ProcessPoolExecutor
+from io import StringIO
+
+# the parsed program and run options, set up once in every worker process
+program = None
+options = None
+
+def init_worker(parsed, run_options):
+    global program, options
+    program = parsed
+    options = run_options
+
+def run_case(case):
+    """run a single case in a worker, returns (status, output, steps, seconds)"""
+
+    output = StringIO()
+    steps = 0
+    start = time.perf_counter()
+
+    try:
+        if options['backend'] == 'compiled':
+            steps = whitespace.run_compiled(program, StringIO(case['input']), output, options['optimize'],
+                                            step_limit=case['step_limit'], time_limit=case['time_limit'])
+        else:
+            steps = whitespace.run(program, StringIO(case['input']), output, options['optimize'],
+                                   step_limit=case['step_limit'], time_limit=case['time_limit'])
+    except whitespace.LimitExceeded as e:
+        status = 'step limit' if isinstance(e, whitespace.StepLimitExceeded) else 'time limit'
+        steps = e.steps
+    except Exception as e:
+        status = 'error: %s' % e
+    else:
+        status = 'pass' if output.getvalue() == case['expected'] else 'fail'
+
+    return status, output.getvalue(), steps, time.perf_counter() - start
+
+def load_cases(f, defaults):
+    """read cases from a JSONL file, filling in defaults for missing keys"""
+
+    cases = []
+
+    for line in f:
+        if not line.strip():
+            continue
+
+        case = dict(defaults)
+        case.update(json.loads(line))
+        case.setdefault('input', '')
+        cases.append(case)
+
+    return cases
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a whitespace program against expected outputs in parallel')
+
+    parser.add_argument('program', type=argparse.FileType('r'),
+                        help='the whitespace program to test')
+    parser.add_argument('cases', type=argparse.FileType('r'),
+                        help='JSONL file of {"input", "expected"} cases')
+    parser.add_argument('-n', '--no-clean', action='store_true',
+                        help='use this if the given file already contains cleaned code (only s/t/n characters)')
+    parser.add_argument('-b', '--backend', default='interpret', choices=whitespace.BACKENDS,
+                        help='execution strategy: interpret commands one by one or compile to python first')
+    parser.add_argument('--no-optimize', dest='optimize', action='store_false',
+                        help='run the commands as written, without the peephole optimizer')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='number of worker processes (default: number of CPUs)')
+    parser.add_argument('--step-limit', type=int, default=None,
+                        help='default maximum number of steps per case')
+    parser.add_argument('--time-limit', type=float, default=None,
+                        help='default maximum number of seconds per case')
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help='only report failing cases and the summary')
+
+    args = parser.parse_args()
+
+    with args.program as f:
+        parsed = whitespace.load(f.read(), args.no_clean)
+
+    # optimize once here, the lowered program is pickled along to every worker
+    parsed.lower(args.optimize)
+
+    with args.cases:
+        cases = load_cases(args.cases, {'step_limit': args.step_limit, 'time_limit': args.time_limit})
+
+    start = time.perf_counter()
+    passed = 0
+    total_steps = 0
+
+    jobs = args.jobs or os.cpu_count() or 1
+    # a few chunks per worker keeps the load balanced without one round trip per case
+    chunksize = max(1, len(cases) // (4 * jobs))
+
+    run_options = {'backend': args.backend, 'optimize': args.optimize}
+
+    with ProcessPoolExecutor(jobs, initializer=init_worker, initargs=(parsed, run_options)) as executor:
+        results = executor.map(run_case, cases, chunksize=chunksize)
+
+        for i, (case, (status, output, steps, seconds)) in enumerate(zip(cases, results)):
+            total_steps += steps
+
+            if status == 'pass':
+                passed += 1
+                if args.quiet:
+                    continue
+
+            print('%5d %-10s %12d steps %8.3fs' % (i, status, steps, seconds))
+            if status == 'fail':
+                print('      expected %r, got %r' % (case['expected'], output))
+
+    elapsed = time.perf_counter() - start
+
+    print('%d/%d passed in %.3fs (%.1f cases/s, %.0f steps/s)' % (
+        passed, len(cases), elapsed, len(cases) / elapsed if elapsed else 0, total_steps / elapsed if elapsed else 0))
+
+    sys.exit(0 if passed == len(cases) else 1)
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,18 @@
 #!/usr/bin/env python
 
 import argparse
+import builtins
+import codecs
+import functools
+import hashlib
+import json
+import os
+import struct
 import sys
+import time
+from array import array
 from enum import Enum
-from io import TextIOBase, StringIO
+from io import BufferedIOBase, RawIOBase, TextIOBase, StringIO
 from collections import defaultdict
 
 """
@@ -32,6 +41,8 @@ class Command:
 
         self.number = number
         self.label = label
+        # index of the command the label refers to, set by Program.resolve()
+        self.target = None
 
     def __str__(self):
         return self.ins.name + (' ' + str(self.number) if self.number is not None else '') + (' %r' % str(self.label) if self.label is not None else '')
@@ -40,26 +51,22 @@ class Command:
         return 'Command(%r, %r, %r)' % (self.ins, self.number, self.label)
 
 class Program:
-    """class that saves commands and regulates program flow"""
+    """class that saves commands and labels, execution always starts at the first command"""
 
     def __init__(self):
         self.commands = []
         self.labels = {}
-        self.pc = 0
-        self.call_stack = []
-
-    def jump(self, label):
-        """jump execution to a given label"""
-
-        if label not in self.labels:
-            raise ValueError('tried to jump to nonexistent label: %r' % (label,))
-
-        self.pc = self.labels[label]
-
-    def advance(self):
-        """advance the program counter by 1"""
-
-        self.pc += 1
+        # generated python functions for the compiled backend by optimize flag, see generate_function()
+        self.functions = {}
+        # (opcodes, operands) by optimize flag, see lower()
+        self.lowered = {}
+
+    def __getstate__(self):
+        # functions can't be pickled, workers regenerate them. lowered programs are plain lists and
+        # travel along, so workers don't have to optimize again
+        state = dict(self.__dict__)
+        state['functions'] = {}
+        return state
 
     def add_command(self, cmd):
         """adds a command to the program. Handles label markers"""
@@ -71,23 +78,36 @@ class Program:
         else:
             self.commands.append(cmd)
 
-    def get_command(self):
-        """return the command at the current pc"""
+    def resolve(self):
+        """set the target of every command with a label argument, raises ValueError for undefined labels"""
+
+        for cmd in self.commands:
+            if cmd.label is not None:
+                if cmd.label not in self.labels:
+                    raise ValueError('tried to jump to nonexistent label: %r' % (cmd.label,))
+                cmd.target = self.labels[cmd.label]
+
+    def lower(self, optimize=True):
+        """
+        optimize: run the peephole optimizer and the stack verifier, see peephole() and verify()
+        returns: (opcodes, operands), parallel lists with the opcode of every command and its number or
+        resolved label, followed by an END opcode. the lists are cached and must not be modified
+        """
 
-        if self.pc >= len(self.commands):
-            raise ValueError('unexpected end of program')
-        return self.commands[self.pc]
+        if optimize not in self.lowered:
+            opcodes = [cmd.ins.opcode for cmd in self.commands]
+            operands = [cmd.target if cmd.label is not None else cmd.number for cmd in self.commands]
 
-    def call(self, label):
-        """jump to label and store the return address"""
+            opcodes.append(END)
+            operands.append(None)
 
-        self.call_stack.append(self.pc)
-        self.jump(label)
+            if optimize:
+                opcodes, operands = peephole(opcodes, operands)
+                opcodes = verify(opcodes, operands)
 
-    def ret(self):
-        """return execution to the address stored by the last call()"""
+            self.lowered[optimize] = opcodes, operands
 
-        self.pc = self.call_stack.pop()
+        return self.lowered[optimize]
 
     def __str__(self):
         out = ['\t' + str(cmd) for cmd in self.commands]
@@ -161,6 +181,202 @@ class Instruction(Enum):
 
         return obj
 
+# small integer opcodes for lowered programs, see Program.lower()
+for opcode, ins in enumerate(Instruction):
+    ins.opcode = opcode
+
+(PUSH, DUP_N, DISCARD_N, DUP, SWAP, DISCARD,
+ ADD, SUB, MUL, DIV, MOD,
+ STORE, GET,
+ OUT_C, OUT_N, IN_C, IN_N,
+ MARK, CALL, JUMP, JZ, JLZ, RET, EXIT) = (ins.opcode for ins in Instruction)
+
+# marks the end of a lowered program
+END = len(Instruction)
+
+# instructions by opcode
+INSTRUCTIONS = list(Instruction)
+
+# superinstructions, only produced by peephole()
+PUSH_ADD, PUSH_SUB, PUSH_GET, DUP_JZ, DUP_JLZ = range(END+1, END+6)
+
+# variants without the stack depth check, only produced by verify()
+(DUP_UNCHECKED, SWAP_UNCHECKED, DISCARD_UNCHECKED, DUP_N_UNCHECKED,
+ DUP_JZ_UNCHECKED, DUP_JLZ_UNCHECKED) = range(END+6, END+12)
+
+UNCHECKED = {
+    DUP: DUP_UNCHECKED,
+    SWAP: SWAP_UNCHECKED,
+    DISCARD: DISCARD_UNCHECKED,
+    DUP_N: DUP_N_UNCHECKED,
+    DUP_JZ: DUP_JZ_UNCHECKED,
+    DUP_JLZ: DUP_JLZ_UNCHECKED,
+}
+
+# instructions after which execution never continues with the next one
+UNCONDITIONAL = (JUMP, RET, EXIT, END)
+# instructions with a command index operand
+BRANCHES = (CALL, JUMP, JZ, JLZ, DUP_JZ, DUP_JLZ, DUP_JZ_UNCHECKED, DUP_JLZ_UNCHECKED)
+
+# constant folding for push a; push b; op, with a and b as they are popped by the instruction
+FOLD = {
+    ADD: lambda b, a: b+a,
+    SUB: lambda b, a: b-a,
+    MUL: lambda b, a: b*a,
+    DIV: lambda b, a: b//a,
+    MOD: lambda b, a: b%a,
+}
+
+def peephole(opcodes, operands, entry=0):
+    """
+    peephole optimizer for lowered programs, never changes output or errors:
+    turns tail calls (call; ret) into jumps, drops unreachable code after unconditional jumps, folds arithmetic on
+    constants and fuses push n; add / push n; sub / push n; get / dup; jz / dup; jlz into superinstructions
+    entry: index of the first command that is executed
+    returns: (opcodes, operands) like Program.lower()
+    """
+
+    # the ret after a tail call would return straight to the caller's caller, so jumping there instead
+    # returns to the same place without growing the call stack
+    opcodes = [JUMP if op == CALL and opcodes[pc+1] == RET else op for pc, op in enumerate(opcodes)]
+
+    # commands that can be reached other than from the one before them, nothing may be fused into these
+    targets = {entry}
+    for pc, (op, arg) in enumerate(zip(opcodes, operands)):
+        if op in BRANCHES:
+            targets.add(arg)
+        if op == CALL:
+            targets.add(pc+1)
+
+    new_opcodes = []
+    new_operands = []
+    # index of the original command every new one starts at
+    starts = []
+    reachable = True
+
+    for pc, (op, arg) in enumerate(zip(opcodes, operands)):
+        if pc in targets:
+            reachable = True
+        elif not reachable:
+            continue
+
+        # new_opcodes[-1] can only be extended if nothing jumps to this command or into the last one
+        last = new_opcodes[-1] if new_opcodes and pc not in targets else None
+
+        if op in FOLD and last == PUSH:
+            a = new_operands[-1]
+
+            if len(new_opcodes) > 1 and new_opcodes[-2] == PUSH and starts[-1] not in targets and \
+                    not (op in (DIV, MOD) and a == 0):
+                # leave the original ZeroDivisionError to run time
+                del new_opcodes[-1], starts[-1]
+                new_operands.pop()
+                new_operands[-1] = FOLD[op](new_operands[-1], a)
+                continue
+            elif op == ADD or op == SUB:
+                new_opcodes[-1] = PUSH_ADD if op == ADD else PUSH_SUB
+                continue
+        elif op == GET and last == PUSH:
+            new_opcodes[-1] = PUSH_GET
+            continue
+        elif (op == JZ or op == JLZ) and last == DUP:
+            new_opcodes[-1] = DUP_JZ if op == JZ else DUP_JLZ
+            new_operands[-1] = arg
+            continue
+
+        new_opcodes.append(op)
+        new_operands.append(arg)
+        starts.append(pc)
+
+        if op in UNCONDITIONAL:
+            reachable = False
+
+    # every target is the start of a new command, point branches there
+    index = {start: i for i, start in enumerate(starts)}
+    for i, op in enumerate(new_opcodes):
+        if op in BRANCHES:
+            new_operands[i] = index[new_operands[i]]
+
+    return new_opcodes, new_operands
+
+# (stack values a command needs, change of the stack depth) for verify(), dup_n and discard_n are handled there
+STACK_EFFECT = {
+    PUSH: (0, 1), DUP: (1, 1), SWAP: (2, 0), DISCARD: (1, -1),
+    ADD: (2, -1), SUB: (2, -1), MUL: (2, -1), DIV: (2, -1), MOD: (2, -1),
+    STORE: (2, -2), GET: (1, 0),
+    OUT_C: (1, -1), OUT_N: (1, -1), IN_C: (1, -1), IN_N: (1, -1),
+    MARK: (0, 0), CALL: (0, 0), JUMP: (0, 0), JZ: (1, -1), JLZ: (1, -1), RET: (0, 0), EXIT: (0, 0), END: (0, 0),
+    PUSH_ADD: (1, 0), PUSH_SUB: (1, 0), PUSH_GET: (0, 1), DUP_JZ: (1, 0), DUP_JLZ: (1, 0),
+}
+
+# stack depths above this are not tracked exactly by verify(), which keeps it fast for programs that push a lot
+MAX_VERIFIED_DEPTH = 1 << 10
+
+def stack_need(op, arg):
+    """number of stack values op needs to not fail, None if it fails anyway"""
+
+    if op == DUP_N:
+        return arg + 1 if arg >= 0 else None
+    elif op == DISCARD_N:
+        return 0
+
+    return STACK_EFFECT[op][0]
+
+def verify(opcodes, operands, entry=0):
+    """
+    find the smallest stack depth every command of a lowered program can run with, by abstract interpretation
+    over its control flow graph (returns go back to after every call)
+    returns: opcodes with the commands whose stack check can never fail replaced by their UNCHECKED variant
+    """
+
+    returns = [pc+1 for pc, op in enumerate(opcodes) if op == CALL]
+    cap = min(MAX_VERIFIED_DEPTH, max([2] + [arg+1 for op, arg in zip(opcodes, operands) if op == DUP_N]))
+
+    # smallest known depth before every command, None where it is never reached
+    depths = [None] * len(opcodes)
+    depths[entry] = 0
+    work = [entry]
+
+    while work:
+        pc = work.pop()
+        op = opcodes[pc]
+        arg = operands[pc]
+        depth = depths[pc]
+
+        # execution only continues if the command did not fail, so it had at least what it needs
+        if op == DUP_N:
+            after = max(depth, arg+1) + 1 if arg >= 0 else depth
+        elif op == DISCARD_N:
+            after = max(min(depth, 1), depth - arg) if arg > 0 else min(depth, 1)
+        else:
+            need, change = STACK_EFFECT[op]
+            after = max(depth, need) + change
+        after = min(after, cap)
+
+        if op == RET:
+            successors = returns
+        elif op in UNCONDITIONAL:
+            successors = [arg] if op == JUMP else []
+        elif op in BRANCHES:
+            # a call continues after itself through the returns
+            successors = [arg] if op == CALL else [arg, pc+1]
+        else:
+            successors = [pc+1]
+
+        for successor in successors:
+            if depths[successor] is None or after < depths[successor]:
+                depths[successor] = after
+                work.append(successor)
+
+    verified = list(opcodes)
+    for pc, (op, arg) in enumerate(zip(opcodes, operands)):
+        if op in UNCHECKED and depths[pc] is not None:
+            need = stack_need(op, arg)
+            if need is not None and depths[pc] >= need:
+                verified[pc] = UNCHECKED[op]
+
+    return verified
+
 def clean(program):
     """strips everything but space/tab/newline, replaces them with s/t/n"""
 
@@ -168,35 +384,45 @@ def clean(program):
             str.maketrans(zip(' \t\n', 'stn'))
         ))
 
-def consume_any(code, choices, offset=0):
+def build_trie(choices):
     """
-    seek from position 'offset' of code until a match in choices is found
-    return (matched choice, position after match)
+    build a trie for looking up Enum members character by character of their value
+    returns: nested dicts keyed by character, the key None maps to the complete choice
+    """
+
+    trie = {}
 
-    >>> whitespace.consume_any('abcdef', ['bcd', 'ab', 'a'], 0)
-    ('a', 1)
-    >>> whitespace.consume_any('abcdef', ['bcd', 'ab', 'a'], 1)
-    ('bcd', 4)
-    >>> whitespace.consume_any('abcdef', ['bcd', 'ab', 'a'], 4)
-    Traceback (most recent call last):
-      File "<stdin>", line 1, in <module>
-      File "whitespace.py", line 185, in consume_any
-        raise ValueError('no match found in %r for %r' % (code_part, choices))
-    ValueError: no match found in 'ef' for ['bcd', 'ab', 'a']
+    for choice in choices:
+        node = trie
+        for c in choice.value:
+            node = node.setdefault(c, {})
+        node[None] = choice
+
+    return trie
+
+# instructions by their code, for consume_instruction()
+INSTRUCTION_TRIE = build_trie(Instruction)
+
+def consume_instruction(code, offset=0):
+    """
+    read an instruction from position 'offset' of code, one character at a time
+    returns: (Instruction, position after the instruction)
     """
 
-    if len(code) <= offset:
-        raise ValueError('tried to consume from empty string')
+    node = INSTRUCTION_TRIE
+    pos = offset
 
-    max_len = max(len(x) for x in choices)
+    while None not in node:
+        if pos >= len(code):
+            raise ValueError('unexpected end of program in instruction at %d' % (offset,))
 
-    code_part = code[offset:]
+        node = node.get(code[pos])
+        if node is None:
+            raise ValueError('no instruction matches %r at %d' % (code[offset:pos+1], offset))
 
-    for pos in range(max_len+1):
-        if code_part[:pos] in choices:
-            return (code_part[:pos], offset+pos)
+        pos += 1
 
-    raise ValueError('no match found in %r for %r' % (code_part, choices))
+    return node[None], pos
 
 def consume_number(code, offset=0):
     """
@@ -205,6 +431,8 @@ def consume_number(code, offset=0):
     """
 
     terminal = code.find('n', offset)
+    if terminal < 0:
+        raise ValueError('unterminated number at %d' % (offset,))
     if terminal == offset:
         raise ValueError('empty number (only terminal, no sign)')
     if terminal == offset+1:
@@ -221,6 +449,8 @@ def consume_label(code, offset=0):
     returns: (found label, position after terminal character)
     """
     terminal = code.find('n', offset)
+    if terminal < 0:
+        raise ValueError('unterminated label at %d' % (offset,))
 
     return code[offset:terminal], terminal+1
 
@@ -232,12 +462,10 @@ def parse(code):
 
     prog = Program()
 
-    last_end = 0
     pos = 0
 
     while pos < len(code):
-        ins, pos = consume_any(code, [ins.value for ins in Instruction], pos)
-        ins = Instruction(ins)
+        ins, pos = consume_instruction(code, pos)
 
         if ins.takes_number:
             num, pos = consume_number(code, pos)
@@ -249,135 +477,1089 @@ def parse(code):
             cmd = Command(ins)
 
         prog.add_command(cmd)
-        last_end = pos
+
+    prog.resolve()
 
     return prog
 
-def run(program, inp, output):
-    """takes Program, input and output TextIO"""
+class StreamOutput:
+    """program output to a text or binary file-like sink, collected and written in bulk (utf-8 encoded for binary sinks)"""
+
+    def __init__(self, outfile, buffer_size=1 << 16):
+        """buffer_size: write the output once this many characters are pending (0 to write every character)"""
+
+        self.outfile = outfile
+        self.binary = isinstance(outfile, (RawIOBase, BufferedIOBase))
+        self.buffer_size = buffer_size
+
+        self.pending = []
+        self.pending_size = 0
+
+    def write(self, s):
+        """output a string"""
+
+        self.pending.append(s)
+        self.pending_size += len(s)
+
+        if self.pending_size >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """write all pending output"""
+
+        if self.pending:
+            out = ''.join(self.pending)
+            self.outfile.write(out.encode('utf-8', 'replace') if self.binary else out)
+            self.pending.clear()
+            self.pending_size = 0
+
+        if hasattr(self.outfile, 'flush'):
+            self.outfile.flush()
+
+class BlockInput:
+    """program input from a binary stream, read in blocks and decoded as utf-8"""
+
+    def __init__(self, infile, block_size=1 << 16, flush=None):
+        """flush: called before waiting for more input, to show any prompt"""
+
+        self.read_block = getattr(infile, 'read1', infile.read)
+        self.block_size = block_size
+        self.flush = flush
+
+        self.decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        self.buf = ''
+        self.pos = 0
+
+    def fill(self):
+        """read the next block of input, returns False on EOF"""
+
+        if self.flush is not None:
+            self.flush()
+
+        while True:
+            block = self.read_block(self.block_size)
+            block = self.decoder.decode(block, final=not block)
+
+            if block:
+                self.buf = self.buf[self.pos:] + block
+                self.pos = 0
+                return True
+            elif self.decoder.getstate()[0]:
+                # only part of a multibyte character so far
+                continue
+
+            return False
+
+    def read(self, size=1):
+        """read up to size characters, returns '' on EOF"""
+
+        while len(self.buf) - self.pos < size and self.fill():
+            pass
+
+        out = self.buf[self.pos:self.pos+size]
+        self.pos += len(out)
+
+        return out
+
+    def readline(self):
+        """read up to and including the next newline, returns '' on EOF"""
+
+        end = self.buf.find('\n', self.pos)
+        while end < 0:
+            searched = len(self.buf) - self.pos
+            if not self.fill():
+                end = len(self.buf) - 1
+                break
+            end = self.buf.find('\n', searched)
+
+        out = self.buf[self.pos:end+1]
+        self.pos = end + 1
+
+        return out
+
+# addresses up to this far past the end of the dense part of a Heap still grow it
+DENSE_SLACK = 1 << 10
+
+INT64_MIN = -1 << 63
+INT64_MAX = (1 << 63) - 1
+
+# what to do when a value leaves the int64 range in int64 mode
+OVERFLOW = ['error', 'bigint']
+
+class Heap:
+    """
+    whitespace heap, small non-negative addresses are kept in a dense list and everything else in a dict
+    the run loops access dense and sparse directly and only call store() for anything else
+    """
+
+    def __init__(self, int64=False):
+        """int64: keep the dense part in an array('q') and only accept values in the int64 range"""
+
+        self.int64 = int64
+        # marks unset cells of the dense part, a value equal to it is always stored in sparse
+        self.unset = INT64_MIN if int64 else None
+        self.dense = array('q') if int64 else []
+        self.sparse = {}
+
+    def store(self, address, value):
+        """set the value at any address, raises OverflowError for values out of range in int64 mode"""
+
+        if self.int64 and not INT64_MIN <= value <= INT64_MAX:
+            raise OverflowError('int64 overflow')
+
+        if value == self.unset or address < 0 or address >= 2*len(self.dense) + DENSE_SLACK:
+            if 0 <= address < len(self.dense):
+                self.dense[address] = self.unset
+            self.sparse[address] = value
+            return
+
+        if address >= len(self.dense):
+            old = len(self.dense)
+            self.dense.extend([self.unset] * (max(address+1, 2*old) - old))
+
+            # addresses that were too far out before now belong to the dense part
+            for moved in [a for a, v in self.sparse.items() if old <= a < len(self.dense) and v != self.unset]:
+                self.dense[moved] = self.sparse.pop(moved)
+
+        self.dense[address] = value
 
+    def get(self, address):
+        """returns: the value at address, raises ValueError if it was never set"""
+
+        if 0 <= address < len(self.dense) and self.dense[address] != self.unset:
+            return self.dense[address]
+
+        value = self.sparse.get(address)
+        if value is None:
+            raise ValueError('bad heap address: %s' % (address,))
+
+        return value
+
+    def promote(self):
+        """switch an int64 heap over to python ints"""
+
+        if self.int64:
+            self.dense = [None if value == self.unset else value for value in self.dense]
+            self.unset = None
+            self.int64 = False
+
+    def stats(self):
+        """returns: dict of the heap footprint: dense cells allocated and set, sparse cells and approximate bytes"""
+
+        return {
+            'dense_cells': len(self.dense),
+            'dense_used': len(self.dense) - self.dense.count(self.unset),
+            'sparse_cells': len(self.sparse),
+            'bytes': sys.getsizeof(self.dense) + sys.getsizeof(self.sparse),
+        }
+
+# number of steps between clock checks when running with a time limit
+TIME_CHECK_INTERVAL = 1 << 16
+
+class LimitExceeded(Exception):
+    """raised when a program runs for longer than allowed"""
+
+    def __init__(self, message, steps):
+        super().__init__(message)
+        self.steps = steps
+
+class StepLimitExceeded(LimitExceeded):
+    def __init__(self, steps):
+        super().__init__('step limit exceeded after %d steps' % steps, steps)
+
+class TimeLimitExceeded(LimitExceeded):
+    def __init__(self, steps):
+        super().__init__('time limit exceeded after %d steps' % steps, steps)
+
+def limit_checker(step_limit=None, time_limit=None):
+    """
+    returns: check_limits(steps) for the run loops, which raises a LimitExceeded if a limit is exceeded and
+    returns the step count at which to call it again
+    the run loops count steps and check limits at jumps, so straight-line code can run slightly over
+    """
+
+    if step_limit is None:
+        step_limit = float('inf')
+    deadline = None if time_limit is None else time.monotonic() + time_limit
+
+    def check_limits(steps):
+        if steps > step_limit:
+            raise StepLimitExceeded(steps)
+        if deadline is None:
+            return step_limit
+
+        if time.monotonic() > deadline:
+            raise TimeLimitExceeded(steps)
+
+        return min(step_limit, steps + TIME_CHECK_INTERVAL)
+
+    return check_limits
+
+# default maximum number of nested calls, None for no limit
+MAX_CALL_DEPTH = 1 << 20
+# initial number of return addresses of the preallocated call stack in run()
+CALL_STACK_SIZE = 1 << 6
+
+def grow_call_stack(call_stack, max_call_depth):
+    """
+    double the preallocated return address array call_stack in place, an empty one gets CALL_STACK_SIZE entries
+    raises ValueError if it is already max_call_depth long, returns: the new length
+    """
+
+    if max_call_depth is not None and len(call_stack) >= max_call_depth:
+        raise ValueError('call stack overflow: more than %d nested calls' % (max_call_depth,))
+
+    size = len(call_stack) or CALL_STACK_SIZE
+    if max_call_depth is not None:
+        size = min(size, max_call_depth - len(call_stack))
+    call_stack.frombytes(bytes(call_stack.itemsize * size))
+
+    return len(call_stack)
+
+def run(program, inp, output, optimize=True, heap=None, int64=False, overflow='error', step_limit=None,
+        time_limit=None, max_call_depth=MAX_CALL_DEPTH):
+    """
+    takes Program, input and output TextIO, optimize runs the peephole optimizer first
+    heap: Heap for the program to use, to inspect it afterwards
+    int64: keep the stack and heap in array('q') buffers, values leaving the int64 range either raise
+        ValueError (overflow='error') or switch everything over to python ints (overflow='bigint')
+    step_limit, time_limit: raise LimitExceeded after about this many commands or seconds, see limit_checker()
+    max_call_depth: raise ValueError when calls nest deeper than this, None for no limit
+    returns: the number of commands executed (after optimization)
+    """
+
+    if overflow not in OVERFLOW:
+        raise ValueError('unknown overflow behaviour: %r' % (overflow,))
+
+    opcodes, operands = program.lower(optimize)
+    stack = array('q') if int64 else []
+    # return addresses below call_sp are in use, allocated by the first call
+    call_stack = array('q')
+    call_size = 0
+    call_sp = 0
+    if heap is None:
+        heap = Heap(int64)
+    elif heap.int64 != int64:
+        raise ValueError('heap does not match the int64 mode')
+    pc = 0
+
+    check_limits = limit_checker(step_limit, time_limit)
+    check_at = check_limits(0)
+    steps = 0
+    # start of the commands executed in order since the last jump, steps only count up at jumps
+    seg = pc
+
+    while True:
+        push = stack.append
+        pop = stack.pop
+        dense = heap.dense
+        sparse = heap.sparse
+        unset = heap.unset
+        heap_store = heap.store
+
+        try:
+            # roughly ordered by how often instructions run in typical programs
+            while True:
+                op = opcodes[pc]
+                arg = operands[pc]
+                pc += 1
+
+                if op == PUSH:
+                    push(arg)
+                elif op == PUSH_ADD:
+                    a = pop()
+                    push(a+arg)
+                elif op == DUP_JZ_UNCHECKED:
+                    if stack[-1] == 0:
+                        steps += pc - seg
+                        if steps > check_at:
+                            check_at = check_limits(steps)
+                        pc = seg = arg
+                elif op == DUP_JZ:
+                    if not stack:
+                        raise ValueError('tried to dup empty stack')
+                    if stack[-1] == 0:
+                        steps += pc - seg
+                        if steps > check_at:
+                            check_at = check_limits(steps)
+                        pc = seg = arg
+                elif op == PUSH_SUB:
+                    a = pop()
+                    push(a-arg)
+                elif op == PUSH_GET:
+                    if arg >= 0:
+                        try:
+                            a = dense[arg]
+                        except IndexError:
+                            a = sparse.get(arg)
+                        else:
+                            if a == unset:
+                                a = sparse.get(arg)
+                    else:
+                        a = sparse.get(arg)
+                    if a is None:
+                        raise ValueError('bad heap address: %s' % (arg,))
+                    push(a)
+                elif op == ADD:
+                    a = pop()
+                    b = pop()
+                    push(b+a)
+                elif op == SUB:
+                    a = pop()
+                    b = pop()
+                    push(b-a)
+                elif op == JZ:
+                    if pop() == 0:
+                        steps += pc - seg
+                        if steps > check_at:
+                            check_at = check_limits(steps)
+                        pc = seg = arg
+                elif op == JUMP:
+                    steps += pc - seg
+                    if steps > check_at:
+                        check_at = check_limits(steps)
+                    pc = seg = arg
+                elif op == DUP_UNCHECKED:
+                    push(stack[-1])
+                elif op == DUP:
+                    if not stack:
+                        raise ValueError('tried to dup empty stack')
+                    push(stack[-1])
+                elif op == GET:
+                    a = pop()
+                    if a >= 0:
+                        try:
+                            b = dense[a]
+                        except IndexError:
+                            b = sparse.get(a)
+                        else:
+                            if b == unset:
+                                b = sparse.get(a)
+                    else:
+                        b = sparse.get(a)
+                    if b is None:
+                        raise ValueError('bad heap address: %s' % (a,))
+                    push(b)
+                elif op == STORE:
+                    a = pop()
+                    b = pop()
+                    if b >= 0 and a != unset:
+                        try:
+                            dense[b] = a
+                        except IndexError:
+                            heap_store(b, a)
+                    else:
+                        heap_store(b, a)
+                elif op == JLZ:
+                    if pop() < 0:
+                        steps += pc - seg
+                        if steps > check_at:
+                            check_at = check_limits(steps)
+                        pc = seg = arg
+                elif op == DUP_JLZ_UNCHECKED:
+                    if stack[-1] < 0:
+                        steps += pc - seg
+                        if steps > check_at:
+                            check_at = check_limits(steps)
+                        pc = seg = arg
+                elif op == DUP_JLZ:
+                    if not stack:
+                        raise ValueError('tried to dup empty stack')
+                    if stack[-1] < 0:
+                        steps += pc - seg
+                        if steps > check_at:
+                            check_at = check_limits(steps)
+                        pc = seg = arg
+                elif op == SWAP_UNCHECKED:
+                    stack[-1], stack[-2] = stack[-2], stack[-1]
+                elif op == SWAP:
+                    if len(stack) < 2:
+                        raise ValueError('tried to swap less than 2 elements')
+                    stack[-2:] = stack[-1:-3:-1]
+                elif op == DISCARD_UNCHECKED:
+                    pop()
+                elif op == DISCARD:
+                    if not stack:
+                        raise ValueError('tried to discard from empty stack')
+                    pop()
+                elif op == CALL:
+                    if call_sp == call_size:
+                        call_size = grow_call_stack(call_stack, max_call_depth)
+                    call_stack[call_sp] = pc
+                    call_sp += 1
+                    steps += pc - seg
+                    if steps > check_at:
+                        check_at = check_limits(steps)
+                    pc = seg = arg
+                elif op == RET:
+                    if not call_sp:
+                        # what popping an empty list of return addresses raised before
+                        raise IndexError('pop from empty list')
+                    call_sp -= 1
+                    steps += pc - seg
+                    if steps > check_at:
+                        check_at = check_limits(steps)
+                    pc = seg = call_stack[call_sp]
+                elif op == MUL:
+                    a = pop()
+                    b = pop()
+                    push(b*a)
+                elif op == DIV:
+                    a = pop()
+                    b = pop()
+                    push(b//a)
+                elif op == MOD:
+                    a = pop()
+                    b = pop()
+                    push(b%a)
+                elif op == DUP_N_UNCHECKED:
+                    push(stack[-arg-1])
+                elif op == DUP_N:
+                    if arg >= len(stack):
+                        raise ValueError('tried to duplicate too far down the stack')
+                    push(stack[len(stack)-arg-1])
+                elif op == DISCARD_N:
+                    n = arg if arg > 0 else len(stack)
+                    del stack[-n-1:-1]
+                elif op == OUT_C:
+                    output.write(chr(pop()))
+                elif op == OUT_N:
+                    output.write(str(pop()))
+                elif op == IN_C:
+                    a = inp.read(1)
+                    if not a:
+                        raise ValueError('unexpected EOF on input')
+                    b = pop()
+
+                    heap_store(b, ord(a))
+                elif op == IN_N:
+                    a = inp.readline()
+                    if not a:
+                        raise ValueError('unexpected EOF on input')
+                    b = pop()
+
+                    heap_store(b, int(a))
+                elif op == EXIT:
+                    return steps + pc - seg
+                elif op == END:
+                    raise ValueError('unexpected end of program')
+                elif op == MARK:
+                    raise ValueError('leftover mark')
+                else:
+                    raise ValueError('unknown instruction')
+        except OverflowError:
+            # chr() raises it for huge values in any mode
+            if not int64 or op == OUT_C:
+                raise
+            if overflow == 'error':
+                raise ValueError('int64 overflow at command %d' % (pc-1,))
+
+            stack = list(stack)
+            heap.promote()
+            int64 = False
+
+            # put back what the command popped and run it again on python ints
+            if op in (ADD, SUB, MUL, DIV, MOD):
+                stack.append(b)
+                stack.append(a)
+                pc -= 1
+            elif op == PUSH_ADD or op == PUSH_SUB:
+                stack.append(a)
+                pc -= 1
+            elif op == PUSH:
+                pc -= 1
+            elif op == IN_N:
+                # the line was already read
+                heap.store(b, int(a))
+            else:
+                raise
+
+class Profile:
+    """execution statistics of a Program, filled in place by run_profiled()"""
+
+    def __init__(self, program):
+        self.program = program
+        # executions of every command
+        self.counts = [0] * len(program.commands)
+        # by called command index: number of calls, steps including and excluding nested calls
+        self.calls = {}
+        self.inclusive = {}
+        self.exclusive = {}
+        self.max_stack = 0
+        self.max_call_stack = 0
+        self.max_heap = 0
+
+def run_profiled(program, inp, output, profile):
+    """
+    execute the commands of a Program as written (without optimizations) like run(), recording a Profile
+    profile: filled in place, so it is complete even if the program fails
+    """
+
+    opcodes, operands = program.lower(False)
+    counts = profile.counts
+    calls = profile.calls
     stack = []
     call_stack = []
     heap = {}
     pc = 0
+    steps = 0
+
+    # [called command index, steps at the call, steps spent in nested calls] of every active call
+    frames = []
+    # active calls per called command, inclusive steps of recursive calls only count once
+    active = {}
+
+    def leave():
+        target, start, nested = frames.pop()
+        total = steps - start
+
+        profile.exclusive[target] = profile.exclusive.get(target, 0) + total - nested
+        active[target] -= 1
+        if not active[target]:
+            profile.inclusive[target] = profile.inclusive.get(target, 0) + total
+        if frames:
+            frames[-1][2] += total
+
+    try:
+        while True:
+            op = opcodes[pc]
+            arg = operands[pc]
+
+            if op == END:
+                raise ValueError('unexpected end of program')
+
+            counts[pc] += 1
+            steps += 1
+            pc += 1
+
+            if op == PUSH:
+                stack.append(arg)
+            elif op == DUP_N:
+                if arg >= len(stack):
+                    raise ValueError('tried to duplicate too far down the stack')
+                stack.append(stack[len(stack)-arg-1])
+            elif op == DISCARD_N:
+                n = arg if arg > 0 else len(stack)
+                del stack[-n-1:-1]
+            elif op == DUP:
+                if not stack:
+                    raise ValueError('tried to dup empty stack')
+                stack.append(stack[-1])
+            elif op == SWAP:
+                if len(stack) < 2:
+                    raise ValueError('tried to swap less than 2 elements')
+                stack[-2:] = stack[-1:-3:-1]
+            elif op == DISCARD:
+                if not stack:
+                    raise ValueError('tried to discard from empty stack')
+                stack.pop()
+            elif op in FOLD:
+                a = stack.pop()
+                b = stack.pop()
+                stack.append(FOLD[op](b, a))
+            elif op == STORE:
+                a = stack.pop()
+                b = stack.pop()
+                heap[b] = a
+            elif op == GET:
+                a = stack.pop()
+                if a not in heap:
+                    raise ValueError('bad heap address: %s' % (a,))
+                stack.append(heap[a])
+            elif op == OUT_C:
+                output.write(chr(stack.pop()))
+            elif op == OUT_N:
+                output.write(str(stack.pop()))
+            elif op == IN_C or op == IN_N:
+                a = inp.read(1) if op == IN_C else inp.readline()
+                if not a:
+                    raise ValueError('unexpected EOF on input')
+                b = stack.pop()
+
+                heap[b] = ord(a) if op == IN_C else int(a)
+            elif op == CALL:
+                call_stack.append(pc)
+                pc = arg
+
+                calls[arg] = calls.get(arg, 0) + 1
+                active[arg] = active.get(arg, 0) + 1
+                frames.append([arg, steps, 0])
+            elif op == JUMP:
+                pc = arg
+            elif op == JZ:
+                if stack.pop() == 0:
+                    pc = arg
+            elif op == JLZ:
+                if stack.pop() < 0:
+                    pc = arg
+            elif op == RET:
+                pc = call_stack.pop()
+                leave()
+            elif op == EXIT:
+                return
+            else:
+                raise ValueError('unknown instruction')
+
+            if len(stack) > profile.max_stack:
+                profile.max_stack = len(stack)
+            if len(call_stack) > profile.max_call_stack:
+                profile.max_call_stack = len(call_stack)
+            if len(heap) > profile.max_heap:
+                profile.max_heap = len(heap)
+    finally:
+        # calls that never returned end here
+        while frames:
+            leave()
+
+def profile_data(profile):
+    """
+    summarize a Profile from run_profiled()
+    returns: dict with the counts per command and the calls of every called label
+    """
 
-    while True:
-        cmd = program.get_command()
-        ins = cmd.ins
-
-        program.advance()
-
-        if ins == Instruction.push:
-            stack.append(cmd.number)
-        elif ins == Instruction.dup_n:
-            if cmd.number >= len(stack):
-                raise ValueError('tried to duplicate too far down the stack')
-            stack.append(stack[len(stack)-cmd.number-1])
-        elif ins == Instruction.discard_n:
-            n = cmd.number if cmd.number > 0 else len(stack)
-            del stack[-n-1:-1]
-        elif ins == Instruction.dup:
-            if not stack:
-                raise ValueError('tried to dup empty stack')
-            stack.append(stack[-1])
-        elif ins == Instruction.swap:
-            if len(stack) < 2:
-                raise ValueError('tried to swap less than 2 elements')
-            stack[-2:] = stack[-1:-3:-1]
-        elif ins == Instruction.discard:
-            if not stack:
-                raise ValueError('tried to discard from empty stack')
-            stack.pop()
-        elif cmd.imp == IMP.arithmetic:
-            a = stack.pop()
-            b = stack.pop()
-
-            if ins == Instruction.add:
-                stack.append(b+a)
-            elif ins == Instruction.sub:
-                stack.append(b-a)
-            elif ins == Instruction.mul:
-                stack.append(b*a)
-            elif ins == Instruction.div:
-                stack.append(b//a)
-            elif ins == Instruction.mod:
-                stack.append(b%a)
+    program = profile.program
+    labels = {}
+    for label, pos in program.labels.items():
+        labels.setdefault(pos, []).append(label)
+
+    data = {
+        'total': sum(profile.counts),
+        'max_stack': profile.max_stack,
+        'max_call_stack': profile.max_call_stack,
+        'max_heap': profile.max_heap,
+        'commands': [],
+        'end_labels': labels.get(len(program.commands), []),
+        'subroutines': [],
+    }
+
+    for i, (cmd, count) in enumerate(zip(program.commands, profile.counts)):
+        data['commands'].append({'index': i, 'labels': labels.get(i, []), 'command': str(cmd),
+                                 'instruction': cmd.ins.name, 'count': count})
+
+    for target, calls in profile.calls.items():
+        data['subroutines'].append({
+            'index': target,
+            'labels': labels.get(target, []),
+            'calls': calls,
+            'inclusive': profile.inclusive.get(target, 0),
+            'exclusive': profile.exclusive.get(target, 0),
+        })
+
+    return data
+
+def profile_report(data, top=20):
+    """format profile_data() as a text report of the hottest instructions and subroutines, and the annotated program"""
+
+    total = data['total'] or 1
+    out = [
+        '%d commands executed' % data['total'],
+        'max stack depth %d, max call depth %d, max heap cells %d' % (
+            data['max_stack'], data['max_call_stack'], data['max_heap']),
+        '',
+    ]
+
+    by_ins = {}
+    for entry in data['commands']:
+        by_ins[entry['instruction']] = by_ins.get(entry['instruction'], 0) + entry['count']
+    out.append('by instruction:')
+    for name, count in sorted(by_ins.items(), key=lambda item: -item[1]):
+        if count:
+            out.append('  %-10s %12d %6.2f%%' % (name, count, 100 * count / total))
+
+    out += ['', 'subroutines (inclusive steps contain nested calls):',
+            '  %-16s %10s %12s %7s %12s %7s' % ('label', 'calls', 'inclusive', '', 'exclusive', '')]
+    for sub in sorted(data['subroutines'], key=lambda sub: -sub['exclusive'])[:top]:
+        out.append('  %-16s %10d %12d %6.2f%% %12d %6.2f%%' % (
+            '/'.join(map(repr, sub['labels'])), sub['calls'], sub['inclusive'], 100 * sub['inclusive'] / total,
+            sub['exclusive'], 100 * sub['exclusive'] / total))
+
+    out += ['', 'program:']
+    for entry in data['commands']:
+        out += ['%s:' % label for label in entry['labels']]
+        out.append('%12d\t%s' % (entry['count'], entry['command']))
+    out += ['%s:' % label for label in data['end_labels']]
+
+    return '\n'.join(out) + '\n'
+
+# serialized programs: header, labels (header and name) and commands (opcode and arguments)
+CACHE_MAGIC = b'WSBC'
+CACHE_VERSION = 1
+# magic, version, source hash, number of labels, number of commands
+CACHE_HEADER = struct.Struct('<4sB32sII')
+# length of the name, command index
+CACHE_LABEL = struct.Struct('<II')
+CACHE_OPCODE = struct.Struct('<B')
+# length of a number argument in bytes, or index of a label argument
+CACHE_ARG = struct.Struct('<I')
+
+def source_hash(code, is_cleaned=False):
+    """key of the program parsed from code, see load()"""
+
+    return hashlib.sha256(('%d:' % is_cleaned).encode('utf-8') + code.encode('utf-8')).digest()
+
+def serialize(program, digest):
+    """returns: bytes of a parsed Program, for deserialize() with the same source hash digest"""
+
+    labels = list(program.labels)
+    label_index = {label: i for i, label in enumerate(labels)}
+
+    out = [CACHE_HEADER.pack(CACHE_MAGIC, CACHE_VERSION, digest, len(labels), len(program.commands))]
+
+    for label in labels:
+        name = label.encode('ascii')
+        out.append(CACHE_LABEL.pack(len(name), program.labels[label]))
+        out.append(name)
+
+    for cmd in program.commands:
+        out.append(CACHE_OPCODE.pack(cmd.ins.opcode))
+
+        if cmd.number is not None:
+            number = cmd.number.to_bytes(cmd.number.bit_length() // 8 + 1, 'little', signed=True)
+            out.append(CACHE_ARG.pack(len(number)))
+            out.append(number)
+        elif cmd.label is not None:
+            out.append(CACHE_ARG.pack(label_index[cmd.label]))
+
+    return b''.join(out)
+
+def deserialize(data, digest=None):
+    """
+    turn bytes from serialize() back into a Program
+    raises ValueError if data is damaged, from another version or (if given) does not match the source hash digest
+    """
+
+    try:
+        magic, version, data_digest, n_labels, n_commands = CACHE_HEADER.unpack_from(data)
+        if magic != CACHE_MAGIC or version != CACHE_VERSION:
+            raise ValueError('not a version %d whitespace cache file' % (CACHE_VERSION,))
+        if digest is not None and data_digest != digest:
+            raise ValueError('cache file is for different source code')
+
+        prog = Program()
+        labels = []
+        pos = CACHE_HEADER.size
+
+        for _ in range(n_labels):
+            length, target = CACHE_LABEL.unpack_from(data, pos)
+            pos += CACHE_LABEL.size
+            label = bytes(data[pos:pos+length]).decode('ascii')
+            pos += length
+
+            labels.append(label)
+            prog.labels[label] = target
+
+        for _ in range(n_commands):
+            ins = INSTRUCTIONS[CACHE_OPCODE.unpack_from(data, pos)[0]]
+            pos += CACHE_OPCODE.size
+
+            if ins.takes_number:
+                length, = CACHE_ARG.unpack_from(data, pos)
+                pos += CACHE_ARG.size
+                if pos + length > len(data):
+                    raise ValueError('truncated cache file')
+                cmd = Command(ins, number=int.from_bytes(data[pos:pos+length], 'little', signed=True))
+                pos += length
+            elif ins.takes_label:
+                index, = CACHE_ARG.unpack_from(data, pos)
+                pos += CACHE_ARG.size
+                cmd = Command(ins, label=labels[index])
             else:
-                raise ValueError('unknown arithmetic operation')
-        elif ins == Instruction.store:
-            a = stack.pop()
-            b = stack.pop()
-            heap[b] = a
-        elif ins == Instruction.get:
-            a = stack.pop()
-            if a not in heap:
-                raise ValueError('bad heap address: %s' % (a,))
-            stack.append(heap[a])
-        elif ins == Instruction.out_c:
-            output.write(chr(stack.pop()))
-        elif ins == Instruction.out_n:
-            output.write(str(stack.pop()))
-        elif ins == Instruction.in_c:
-            a = inp.read(1)
-            if not a:
-                raise ValueError('unexpected EOF on input')
-            b = stack.pop()
-
-            heap[b] = ord(a)
-        elif ins == Instruction.in_n:
-            a = inp.readline()
-            if not a:
-                raise ValueError('unexpected EOF on input')
-            b = stack.pop()
-
-            heap[b] = int(a)
-        elif ins == Instruction.mark:
-            raise ValueError('leftover mark')
-        elif ins == Instruction.call:
-            program.call(cmd.label)
-        elif ins == Instruction.ret:
-            program.ret()
-        elif ins == Instruction.jump:
-            program.jump(cmd.label)
-        elif ins == Instruction.jz:
-            if stack.pop() == 0:
-                program.jump(cmd.label)
-        elif ins == Instruction.jlz:
-            if stack.pop() < 0:
-                program.jump(cmd.label)
-        elif ins == Instruction.exit:
-            return
+                cmd = Command(ins)
+
+            prog.commands.append(cmd)
+    except (struct.error, IndexError, UnicodeDecodeError):
+        raise ValueError('damaged cache file')
+
+    prog.resolve()
+
+    return prog
+
+@functools.lru_cache(maxsize=32)
+def load(code, is_cleaned=False, cache_dir=None):
+    """
+    clean and parse whitespace code, remembering the last few programs
+    cache_dir: directory to also keep serialized programs in, keyed by a hash of the source
+    returns: Program, shared between calls with the same arguments
+    """
+
+    def build():
+        if is_cleaned:
+            # make sure we still filter out any trailing newlines etc
+            return parse(code.translate(defaultdict(str, str.maketrans({c: c for c in 'stn'}))))
         else:
-            raise ValueError('unknown instruction')
+            return parse(clean(code))
+
+    if cache_dir is None:
+        return build()
+
+    digest = source_hash(code, is_cleaned)
+    path = os.path.join(cache_dir, 'ws-%s.wsbc' % digest.hex())
+
+    try:
+        with open(path, 'rb') as f:
+            return deserialize(f.read(), digest)
+    except (OSError, ValueError):
+        pass
+
+    program = build()
+
+    os.makedirs(cache_dir, exist_ok=True)
+    # write to a temporary file first so concurrent runs never see half a program
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(serialize(program, digest))
+    os.replace(tmp_path, path)
+
+    return program
+
+BACKENDS = ['interpret', 'compiled']
+
+# python source pushing the heap value at address a
+HEAP_GET = [
+    'if a >= 0:',
+    '    try:',
+    '        b = dense[a]',
+    '    except IndexError:',
+    '        b = sparse.get(a)',
+    'else:',
+    '    b = sparse.get(a)',
+    'if b is None:',
+    "    raise ValueError('bad heap address: %%s' %% (a,))",
+    'push(b)',
+]
+
+# python source for every instruction that does not change control flow, arg is the number argument
+STRAIGHT_SOURCE = {
+    PUSH: ['push(%(arg)r)'],
+    DUP_N: [
+        'if %(arg)r >= len(stack):',
+        "    raise ValueError('tried to duplicate too far down the stack')",
+        'push(stack[len(stack)-%(arg)r-1])',
+    ],
+    DISCARD_N: ['del stack[-%(n)s-1:-1]'],
+    DUP: [
+        'if not stack:',
+        "    raise ValueError('tried to dup empty stack')",
+        'push(stack[-1])',
+    ],
+    SWAP: [
+        'if len(stack) < 2:',
+        "    raise ValueError('tried to swap less than 2 elements')",
+        'stack[-2:] = stack[-1:-3:-1]',
+    ],
+    DISCARD: [
+        'if not stack:',
+        "    raise ValueError('tried to discard from empty stack')",
+        'pop()',
+    ],
+    ADD: ['a = pop()', 'b = pop()', 'push(b+a)'],
+    SUB: ['a = pop()', 'b = pop()', 'push(b-a)'],
+    MUL: ['a = pop()', 'b = pop()', 'push(b*a)'],
+    DIV: ['a = pop()', 'b = pop()', 'push(b//a)'],
+    MOD: ['a = pop()', 'b = pop()', 'push(b%%a)'],
+    STORE: [
+        'a = pop()',
+        'b = pop()',
+        'if b >= 0:',
+        '    try:',
+        '        dense[b] = a',
+        '    except IndexError:',
+        '        heap_store(b, a)',
+        'else:',
+        '    sparse[b] = a',
+    ],
+    GET: ['a = pop()'] + HEAP_GET,
+    OUT_C: ['write(chr(pop()))'],
+    OUT_N: ['write(str(pop()))'],
+    IN_C: [
+        'a = read(1)',
+        'if not a:',
+        "    raise ValueError('unexpected EOF on input')",
+        'b = pop()',
+        'heap_store(b, ord(a))',
+    ],
+    IN_N: [
+        'a = readline()',
+        'if not a:',
+        "    raise ValueError('unexpected EOF on input')",
+        'b = pop()',
+        'heap_store(b, int(a))',
+    ],
+    MARK: ["raise ValueError('leftover mark')"],
+    PUSH_ADD: ['push(pop()+%(arg)r)'],
+    PUSH_SUB: ['push(pop()-%(arg)r)'],
+    PUSH_GET: ['a = %(arg)r'] + HEAP_GET,
+    DUP_UNCHECKED: ['push(stack[-1])'],
+    SWAP_UNCHECKED: ['stack[-1], stack[-2] = stack[-2], stack[-1]'],
+    DISCARD_UNCHECKED: ['pop()'],
+    DUP_N_UNCHECKED: ['push(stack[-%(arg)r-1])'],
+}
+
+def generate_python(program, optimize=True):
+    """
+    translate a Program into the python source of a function
+    _ws_main(stack, call_stack, heap, read, readline, write, check_limits, max_call_depth), heap is a Heap,
+    check_limits comes from limit_checker() and max_call_depth is a number, it returns the number of commands executed
 
-    raise ValueError('execution loop exited, something went terribly wrong')
+    every basic block becomes a nested function returning the index of the next block (None to exit),
+    which _ws_main dispatches in a loop
+    optimize: run the peephole optimizer first
+    """
 
-def execute(code, inp=None, is_cleaned=False):
+    opcodes, operands = program.lower(optimize)
+
+    # blocks start at the entry point, at jump and call targets and after every control flow instruction
+    leaders = {0}
+    for pc, (op, arg) in enumerate(zip(opcodes, operands)):
+        if op in BRANCHES or op == RET or op == EXIT:
+            leaders.add(pc+1)
+            if op in BRANCHES:
+                leaders.add(arg)
+    leaders = sorted(leader for leader in leaders if leader < len(opcodes))
+    blocks = {leader: i for i, leader in enumerate(leaders)}
+
+    lines = [
+        'def _ws_main(stack, call_stack, heap, read, readline, write, check_limits, max_call_depth):',
+        '    push = stack.append',
+        '    pop = stack.pop',
+        '    dense = heap.dense',
+        '    sparse = heap.sparse',
+        '    heap_store = heap.store',
+    ]
+
+    for i, start in enumerate(leaders):
+        end = leaders[i+1] if i+1 < len(leaders) else len(opcodes)
+
+        lines.append('')
+        lines.append('    def _block_%d():' % i)
+        body = []
+
+        for pc in range(start, end):
+            op = opcodes[pc]
+            arg = operands[pc]
+
+            if op in STRAIGHT_SOURCE:
+                n = arg if arg is not None and arg > 0 else 'len(stack)'
+                body.extend(line % {'arg': arg, 'n': n} for line in STRAIGHT_SOURCE[op])
+            elif op == JUMP:
+                body.append('return %d' % blocks[arg])
+            elif op == JZ or op == JLZ:
+                body.append('if pop() %s 0:' % ('==' if op == JZ else '<'))
+                body.append('    return %d' % blocks[arg])
+            elif op in (DUP_JZ, DUP_JLZ, DUP_JZ_UNCHECKED, DUP_JLZ_UNCHECKED):
+                if op == DUP_JZ or op == DUP_JLZ:
+                    body.append('if not stack:')
+                    body.append("    raise ValueError('tried to dup empty stack')")
+                body.append('if stack[-1] %s 0:' % ('==' if op in (DUP_JZ, DUP_JZ_UNCHECKED) else '<'))
+                body.append('    return %d' % blocks[arg])
+            elif op == CALL:
+                body.append('if len(call_stack) >= max_call_depth:')
+                body.append("    raise ValueError('call stack overflow: more than %d nested calls' % (max_call_depth,))")
+                body.append('call_stack.append(%d)' % blocks[pc+1])
+                body.append('return %d' % blocks[arg])
+            elif op == RET:
+                body.append('return call_stack.pop()')
+            elif op == EXIT:
+                body.append('return None')
+            elif op == END:
+                body.append("raise ValueError('unexpected end of program')")
+            else:
+                body.append("raise ValueError('unknown instruction')")
+
+        # fall through into the next block, the program always ends in END so there is one
+        if opcodes[end-1] not in (JUMP, CALL, RET, EXIT, END):
+            body.append('return %d' % blocks[end])
+
+        lines.extend('        ' + line for line in body)
+
+    lines.append('')
+    lines.append('    blocks = [%s]' % ', '.join('_block_%d' % i for i in range(len(leaders))))
+    # every block runs to its end unless it fails, so the steps are counted before it runs
+    sizes = [end - start for start, end in zip(leaders, leaders[1:] + [len(opcodes)])]
+    lines.append('    sizes = %r' % (sizes,))
+    lines.append('    steps = 0')
+    lines.append('    check_at = check_limits(0)')
+    lines.append('    block = %d' % blocks[0])
+    lines.append('    while block is not None:')
+    lines.append('        steps += sizes[block]')
+    lines.append('        if steps > check_at:')
+    lines.append('            check_at = check_limits(steps)')
+    lines.append('        block = blocks[block]()')
+    lines.append('    return steps')
+
+    return '\n'.join(lines) + '\n'
+
+def generate_function(program, optimize=True):
+    """compile the source from generate_python(program, optimize) and return the _ws_main function"""
+
+    namespace = {}
+    exec(builtins.compile(generate_python(program, optimize), '<whitespace codegen>', 'exec'), namespace)
+    return namespace['_ws_main']
+
+def run_compiled(program, inp, output, optimize=True, heap=None, step_limit=None, time_limit=None,
+                 max_call_depth=MAX_CALL_DEPTH):
+    """
+    takes Program, input and output TextIO, runs the program as generated python code, see run() for the rest
+    limits are checked between basic blocks
+    """
+
+    if optimize not in program.functions:
+        program.functions[optimize] = generate_function(program, optimize)
+
+    return program.functions[optimize]([], [], Heap() if heap is None else heap, inp.read, inp.readline,
+                                       output.write, limit_checker(step_limit, time_limit),
+                                       float('inf') if max_call_depth is None else max_call_depth)
+
+def execute(code, inp=None, is_cleaned=False, backend='interpret', cache_dir=None, optimize=True,
+            output=None, buffer_size=1 << 16, heap=None, int64=False, overflow='error', profile=None,
+            max_call_depth=MAX_CALL_DEPTH):
     """
     execute whitespace code, with optional input
 
-    inp: TextIO or string to act as input for the program
+    inp: TextIO, binary stream or string to act as input for the program
     is_cleaned: input consists of s/t/n characters already
-
-    returns: the produced output string
+    backend: 'interpret' to run the commands one by one, 'compiled' to translate them to python first
+    cache_dir: directory to keep parsed programs in, see load()
+    optimize: run the peephole optimizer, turn off to debug it
+    output: text or binary file-like object to stream the output to while the program runs
+    buffer_size: number of characters to collect before writing them to output
+    heap: Heap for the program to use, to inspect it afterwards
+    int64, overflow: run with 64 bit stack and heap values, see run() (interpret backend only)
+    profile: Profile to fill, runs the commands as written with run_profiled() instead of the backend
+    max_call_depth: raise ValueError when calls nest deeper than this, None for no limit
+
+    returns: the produced output string, or None if it was written to output
     """
 
-    if is_cleaned:
-        # make sure we still filter out any trailing newlines etc
-        code = code.translate(defaultdict(str, str.maketrans({c: c for c in 'stn'})))
-    else:
-        code = clean(code)
+    sink = StringIO() if output is None else StreamOutput(output, buffer_size)
 
     if isinstance(inp, str):
         inp = StringIO(inp)
+    elif isinstance(inp, (RawIOBase, BufferedIOBase)):
+        inp = BlockInput(inp, flush=sink.flush)
     elif not isinstance(inp, TextIOBase):
         raise ValueError('unable to convert input %r to TextIO' % (inp,))
 
-    output = StringIO()
+    if backend not in BACKENDS:
+        raise ValueError('unknown backend: %r' % (backend,))
+    if int64 and backend != 'interpret':
+        raise ValueError('int64 mode only works with the interpret backend')
 
-    run(parse(code), inp, output)
+    program = load(code, is_cleaned, cache_dir)
 
-    return output.getvalue()
+    try:
+        if profile is not None:
+            run_profiled(program, inp, sink, profile)
+        elif backend == 'compiled':
+            run_compiled(program, inp, sink, optimize, heap, max_call_depth=max_call_depth)
+        else:
+            run(program, inp, sink, optimize, heap, int64, overflow, max_call_depth=max_call_depth)
+    finally:
+        # whatever the program printed before failing is still shown
+        if output is not None:
+            sink.flush()
+
+    return sink.getvalue() if output is None else None
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Run a whitespace program')
@@ -386,17 +1568,55 @@ if __name__ == '__main__':
                         help='the brainfuck program to run')
     parser.add_argument('-n', '--no-clean', action='store_true',
                         help='use this if the given file already contains cleaned code (only s/t/n characters)')
-    parser.add_argument('-o', '--output', metavar='outfile', nargs=1, type=argparse.FileType('w'), default=sys.stdout,
+    parser.add_argument('-b', '--backend', default='interpret', choices=BACKENDS,
+                        help='execution strategy: interpret commands one by one or compile to python first')
+    parser.add_argument('--no-optimize', dest='optimize', action='store_false',
+                        help='run the commands as written, without the peephole optimizer')
+    parser.add_argument('--cache-dir', metavar='DIR',
+                        help='keep parsed programs in this directory')
+    parser.add_argument('-o', '--output', metavar='outfile', type=argparse.FileType('w'), default=sys.stdout,
                         help='file to write the output to')
+    parser.add_argument('--buffer-size', type=int, default=1 << 16,
+                        help='number of characters to collect before writing output (0 to write every character)')
+    parser.add_argument('--int64', action='store_true',
+                        help='keep stack and heap values in 64 bit arrays (interpret backend only)')
+    parser.add_argument('--overflow', default='error', choices=OVERFLOW,
+                        help='in int64 mode, fail or switch to unbounded integers when a value leaves the range')
+    parser.add_argument('--max-call-depth', type=int, default=MAX_CALL_DEPTH,
+                        help='fail when calls nest deeper than this')
+    parser.add_argument('--heap-stats', action='store_true',
+                        help='print the heap footprint to stderr when the program ends')
+    parser.add_argument('--profile', action='store_true',
+                        help='run the commands as written and print execution statistics to stderr')
+    parser.add_argument('--profile-json', metavar='FILE', type=argparse.FileType('w'),
+                        help='write the profile data as JSON (implies --profile)')
 
     args = parser.parse_args()
 
+    if args.max_call_depth < 0:
+        parser.error('--max-call-depth must not be negative')
+
     with args.infile as f:
         code = f.read()
 
-    output = execute(code, sys.stdin, args.no_clean)
-
-    args.output.write(output)
+    heap = Heap(args.int64)
+    profile = None
+    if args.profile or args.profile_json:
+        profile = Profile(load(code, args.no_clean, args.cache_dir))
+
+    try:
+        execute(code, sys.stdin.buffer, args.no_clean, args.backend, args.cache_dir, args.optimize,
+                args.output, args.buffer_size, heap, args.int64, args.overflow, profile, args.max_call_depth)
+    finally:
+        if args.heap_stats:
+            sys.stderr.write('heap: %(dense_used)d/%(dense_cells)d dense cells used, %(sparse_cells)d sparse cells, '
+                             'about %(bytes)d bytes\n' % heap.stats())
+        if profile is not None:
+            data = profile_data(profile)
+            sys.stderr.write(profile_report(data))
+            if args.profile_json:
+                with args.profile_json:
+                    json.dump(data, args.profile_json)
 
     if args.output.isatty():
         args.output.write('\n')